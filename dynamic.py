@@ -1,14 +1,98 @@
 #!/usr/bin/env python3
 import re
+import os
+import json
+import time
 import datetime
-import requests
 import threading
-from fetch import raw2fastly, session, LOCAL
+import traceback
+import functools
+import concurrent.futures
+import requests
+from concurrent.futures import ThreadPoolExecutor, Future
+from types import FunctionType as function
+from typing import Any, Dict, Callable
+from fetch import raw2fastly, session, LOCAL, CACHE_DIR
+
+VPN_FAIL_WORKERS = 8
+DYNAMIC_WORKERS = 8
+DYNAMIC_DEADLINE = 60 # 所有动态生成函数共用的期限（秒），从开始运行时算起
+KKZUI_TTL = 6 * 3600 # kkzui 最新文章地址的缓存时间（秒）
+SHARKDOOR_TTL = 6 * 3600 # sharkdoor 当月文件列表的缓存时间（秒）
+
+class TTLCache:
+    # 跨次运行保存的小型缓存，每一项有各自的有效期；过期的值在重新获取失败时仍可使用
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError): pass
+
+    def get(self, key: str, ttl: float, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.time() - entry['time'] < ttl: return entry['value']
+        try: value = fn()
+        except Exception:
+            if entry: return entry['value']
+            raise
+        with self.lock:
+            self.entries[key] = {'value': value, 'time': time.time()}
+        return value
+
+    def save(self) -> None:
+        with self.lock:
+            now = time.time()
+            # 一周没有更新的项目不再保留
+            entries = {k: v for k, v in self.entries.items() if now - v['time'] < 7 * 24 * 3600}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path+".tmp", 'w', encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(self.path+".tmp", self.path)
+
+dynamic_cache = TTLCache(os.path.join(CACHE_DIR, "dynamic.json"))
+
+class DynamicRunner:
+    # 同时运行所有动态生成函数（最多 workers 个），共用一个期限；超过期限仍未完成的视为超时，
+    # 不再等待。使用守护线程，卡住的函数不会妨碍程序退出
+    def __init__(self, workers: int = DYNAMIC_WORKERS, deadline: float = DYNAMIC_DEADLINE) -> None:
+        self.slots = threading.Semaphore(workers)
+        self.deadline = time.monotonic() + deadline
+
+    def submit(self, fn: Callable[[], Any]) -> Future:
+        fut: Future = Future()
+        def run() -> None:
+            with self.slots:
+                if not fut.set_running_or_notify_cancel(): return
+                try: fut.set_result(fn())
+                except BaseException as e: fut.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        return fut
+
+    def result(self, fut: Future) -> Any:
+        try: return fut.result(timeout=max(0, self.deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError: raise TimeoutError
+
+    def wrap(self, fn: function) -> function:
+        # 立即开始运行，返回同名的函数供 Source 调用，调用时等待结果
+        fut = self.submit(fn)
+        @functools.wraps(fn)
+        def wrapped():
+            return self.result(fut)
+        return wrapped
+
+    def close(self) -> None:
+        dynamic_cache.save()
 
 
 def kkzui():
-    res = session.get("https://kkzui.com/jd?orderby=modified")
-    article_url = re.search(r'<a href="(https://kkzui.com/(.*?)\.html)" title="20(.*?)节点(.*?)</a>',res.text).groups()[0]
+    def latest() -> str:
+        res = session.get("https://kkzui.com/jd?orderby=modified")
+        return re.search(r'<a href="(https://kkzui.com/(.*?)\.html)" title="20(.*?)节点(.*?)</a>',res.text).groups()[0]
+    article_url = dynamic_cache.get('kkzui', KKZUI_TTL, latest)
     res = session.get(article_url)
     sub = res.text.split('<pre')[1].split('</pre>')[0]
     if '</' in sub:
@@ -18,9 +102,12 @@ def kkzui():
     return sub
 
 def sharkdoor():
-    res_json = session.get(datetime.datetime.now().strftime(
-        'https://api.github.com/repos/sharkDoor/vpn-free-nodes/contents/node-list/%Y-%m?ref=master')).json()
-    res = session.get(raw2fastly(res_json[-1]['download_url']))
+    def listing() -> str:
+        res_json = session.get(datetime.datetime.now().strftime(
+            'https://api.github.com/repos/sharkDoor/vpn-free-nodes/contents/node-list/%Y-%m?ref=master')).json()
+        return res_json[-1]['download_url']
+    download_url = dynamic_cache.get(datetime.datetime.now().strftime('sharkdoor/%Y-%m'), SHARKDOOR_TTL, listing)
+    res = session.get(raw2fastly(download_url))
     nodes = set()
     for line in res.text.split('\n'):
         if '://' in line:
@@ -50,9 +137,11 @@ def vpn_fail():
             link = response.split('class="form-control text-center" id="pp2" value="')[1].split('"')[0]
             links.add(link)
         except requests.exceptions.RequestException: pass
-    threads = [threading.Thread(target=get_link, args=(ip,)) for ip in ips]
-    for thread in threads: thread.start()
-    for thread in threads: thread.join()
+    with ThreadPoolExecutor(VPN_FAIL_WORKERS) as pool:
+        futures = [pool.submit(get_link, ip) for ip in ips]
+    # 线程池会吞掉异常，网络错误以外的异常照常输出
+    for fut in futures:
+        if fut.exception() is not None: traceback.print_exception(fut.exception())
     return links
 
 def w1770946466():
@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 import yaml
 import json
+import re
 import base64
+import hashlib
 from urllib.parse import quote, unquote, urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ReadTimeoutError
 import datetime
 import traceback
 import binascii
 import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait
+import queue
+import time
 import sys
 import os
+import contextlib
+import sqlite3
+import zlib
+import socket
+import ipaddress
 from types import FunctionType as function
-from typing import Set, List, Dict, Union, Any, Optional
+from probe import ProbeCache, probe_cached
+from typing import Set, List, Dict, Tuple, Iterator, Iterable, Union, Any, Optional, TextIO, Callable
 
 try: PROXY = open("local_proxy.conf").read().strip()
 except FileNotFoundError: LOCAL = False; PROXY = None
@@ -39,6 +54,120 @@ def b64decodes_safe(s):
     except UnicodeDecodeError: raise
     except binascii.Error: raise
 
+@contextlib.contextmanager
+def atomic_open(path: str, mode: str = 'w', encoding: str = "utf-8") -> Iterator[TextIO]:
+    # 先写入同目录下的临时文件，写完后再替换，避免 CDN 取到写了一半的文件
+    tmp = path+'.tmp'
+    try:
+        with open(tmp, mode, encoding=encoding) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError): os.remove(tmp)
+        raise
+
+class Base64Writer:
+    # 增量 Base64 编码，每次只编码已凑满 3 字节的部分，结果与一次性编码相同
+    def __init__(self, f: TextIO) -> None:
+        self.f = f
+        self.pending = b''
+
+    def write(self, s: str) -> None:
+        data = self.pending + s.encode('utf-8')
+        n = len(data) - len(data) % 3
+        self.f.write(base64.b64encode(data[:n]).decode('utf-8'))
+        self.pending = data[n:]
+
+    def close(self) -> None:
+        self.f.write(base64.b64encode(self.pending).decode('utf-8'))
+        self.pending = b''
+
+class Stopwatch:
+    # 记录各阶段的耗时：每次调用 lap() 记下从上一次调用（或创建时）到现在的时间
+    def __init__(self) -> None:
+        self.started = datetime.datetime.now()
+        self.start = self.last = time.monotonic()
+        self.stages: Dict[str, float] = {}
+
+    def lap(self, name: str) -> None:
+        now = time.monotonic()
+        self.stages[name] = round(self.stages.get(name, 0) + now - self.last, 3)
+        self.last = now
+
+    def record(self, name: str, seconds: float) -> None:
+        # 与其他阶段同时进行的阶段（如展开机场列表）单独记下耗时，不影响 lap() 的计时
+        self.stages[name] = round(seconds, 3)
+
+    @property
+    def total(self) -> float:
+        return round(time.monotonic() - self.start, 3)
+
+# Clash 配置的快速写出：proxies / proxy-groups / rules / payload 直接按已知结构写出，
+# 其余部分交给 LibYAML（如果可用）。字符串一律显式引号，数字密码无需 '!!str' 标记。
+YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+YAML_PLAIN = re.compile(r'[A-Za-z][A-Za-z0-9_.\-/]*')
+YAML_RESERVED = frozenset("y n yes no on off true false null".split())
+YAML_ESCAPE = re.compile('[\\\\"\x00-\x1f\x7f-\x9f\u2028\u2029\ufeff\ud800-\udfff\ufffe\uffff]')
+YAML_ESCAPES = {'\\': '\\\\', '"': '\\"', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+                '\x85': '\\N', '\u2028': '\\L', '\u2029': '\\P'}
+CLASH_SECTIONS = ('proxies', 'proxy-groups', 'rules', 'payload')
+
+def _yaml_escape(m: "re.Match[str]") -> str:
+    ch = m.group()
+    if ch in YAML_ESCAPES: return YAML_ESCAPES[ch]
+    if ord(ch) <= 0xff: return f"\\x{ord(ch):02x}"
+    return f"\\u{ord(ch):04x}"
+
+def yaml_scalar(val: Any) -> str:
+    if isinstance(val, str):
+        if YAML_PLAIN.fullmatch(val) and val.lower() not in YAML_RESERVED:
+            return val
+        return '"'+YAML_ESCAPE.sub(_yaml_escape, val)+'"'
+    if val is True: return 'true'
+    if val is False: return 'false'
+    if val is None: return 'null'
+    if isinstance(val, int): return str(val)
+    # PyYAML 会把 bytes 写成块标量，不能放在单行的映射中
+    if isinstance(val, (bytes, bytearray)): return '!!binary "'+base64.b64encode(val).decode()+'"'
+    # 浮点数、日期、bytes 等交给 PyYAML 的表示器（如 1e-07 须写成 1.0e-07 才会读回浮点数）
+    out = yaml.dump(val, Dumper=YAML_DUMPER, default_flow_style=True, allow_unicode=True, width=2**31-1)
+    if out.endswith('\n...\n'): out = out[:-4]
+    return out.strip()
+
+def yaml_flow(val: Any) -> str:
+    if isinstance(val, dict):
+        return '{'+', '.join([yaml_scalar(k)+': '+yaml_flow(v) for k, v in val.items()])+'}'
+    if isinstance(val, (list, tuple)):
+        return '['+', '.join([yaml_flow(_) for _ in val])+']'
+    return yaml_scalar(val)
+
+def dump_clash(conf: Dict[str, Any], f: TextIO) -> None:
+    for key, val in conf.items():
+        if key not in CLASH_SECTIONS or not isinstance(val, list):
+            yaml.dump({key: val}, f, Dumper=YAML_DUMPER, allow_unicode=True, sort_keys=False)
+            continue
+        if not val:
+            f.write(yaml_scalar(key)+': []\n')
+            continue
+        f.write(yaml_scalar(key)+':\n')
+        if key == 'proxy-groups':
+            # 策略组保持块格式，便于阅读
+            for group in val:
+                if not isinstance(group, dict):
+                    f.write('- '+yaml_flow(group)+'\n')
+                    continue
+                prefix = '- '
+                for k, v in group.items():
+                    if isinstance(v, list) and v:
+                        f.write(prefix+yaml_scalar(k)+':\n')
+                        for _ in v: f.write('  - '+yaml_flow(_)+'\n')
+                    else:
+                        f.write(prefix+yaml_scalar(k)+': '+yaml_flow(v)+'\n')
+                    prefix = '  '
+        else:
+            for item in val:
+                f.write('- '+yaml_flow(item)+'\n')
+
 DEFAULT_UUID = '8'*8+'-8888'*3+'-'+'8'*12
 
 CLASH2VMESS = {'name': 'ps', 'server': 'add', 'port': 'port', 'uuid': 'id', 
@@ -78,9 +207,61 @@ ABFURLS = (
 FAKE_IPS = "8.8.8.8; 8.8.4.4; 1.1.1.1; 1.0.0.1; 4.2.2.2; 4.2.2.1; 114.114.114.114; 127.0.0.1".split('; ')
 FAKE_DOMAINS = ".google.com .github.com".split()
 
-FETCH_TIMEOUT = (6, 5)
+FETCH_TIMEOUT = (6, 5) # 连接超时、读取间隔超时（秒）
+FETCH_DEADLINE = 30 # 单个订阅从发起请求到读取完毕的最长时间（秒）
+FETCH_WORKERS = 32
+FETCH_PER_HOST = 6
+FETCH_DEADLINE_MIN = 10 # 多次运行都没有贡献节点的订阅的期限（秒）
+FETCH_DEADLINE_MAX = 90 # 慢但有贡献的订阅最多可以延长到的期限（秒）
+SOURCE_SKIP_AFTER = 3 # 连续这么多次运行失败（出错或为空）后开始跳过该订阅
+SOURCE_REPROBE_MAX = 16 # 跳过的次数按连续失败次数翻倍，最多跳过这么多次就再试一次
+
+SESSION_POOL = FETCH_WORKERS # 每个主机保持的连接数，与抓取并发数一致以便复用连接
+SESSION_RETRIES = 2 # 连接失败或返回以下状态码时的重试次数
+SESSION_RETRY_STATUS = (429, 500, 502, 503, 504)
+SESSION_BACKOFF = 0.5 # 重试间隔的退避系数（秒）
+SESSION_RETRY_AFTER_MAX = 5 # 服务器通过 Retry-After 要求等待的时间超过这么久时只等这么久（秒）
+# 按主机设置的策略：rate 为每秒最多发出的请求数，retries / backoff 覆盖上面的默认值
+HOST_POLICIES: Dict[str, Dict[str, float]] = {
+    'api.github.com': {'rate': 1, 'retries': 1, 'backoff': 2},
+    'raw.githubusercontent.com': {'rate': 20},
+    'ghproxy.com': {'rate': 5},
+    'vpn.fail': {'rate': 4},
+}
+
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_BATCH = 2000 # 每次交给解析进程的行数
+PARSE_INFLIGHT = PARSE_WORKERS * 4 # 最多同时等待解析的批次，超过时暂停接收抓取结果
+FETCH_BACKLOG = 32 # 抓取完成但尚未交给解析的订阅数上限，超过时抓取线程暂停
+AIRPORT_WORKERS = 8
+AIRPORT_DEADLINE = 30 # 单个机场列表的最长下载时间（秒）
+MERGE_BACKLOG = 64 # 等待合并的订阅数上限
+MERGE_WINDOW = 128 # 已开始抓取但尚未合并的订阅数上限，超过时只开始抓取下一个要合并的订阅
+
+CACHE_DIR = ".cache" # 跨次运行保留的缓存，在 Actions 中由 actions/cache 恢复
+HTTP_CACHE_SIZE = 512 * 1024 * 1024
+HTTP_CACHE_MAX_AGE = 7 * 24 * 3600 # 超过这么久没有用到的缓存会被清除（秒）
+NODE_STORE_MAX_AGE = 30 * 24 * 3600 # 节点库中超过这么久没有出现的订阅和节点会被清除（秒）
+# 解析代码的版本：本文件有任何改动时节点库中保存的解析结果全部作废，修复过的解析器才能用到内容不变的订阅上
+with open(__file__, 'rb') as _f: PARSE_VERSION = hashlib.sha256(_f.read()).hexdigest()[:16]
+
+ADBLOCK_WORKERS = 8
+ADBLOCK_DEADLINE = 90 # 单个 Adblock 列表的最长下载时间（秒）
+FETCH_CHUNK_SIZE = 64 * 1024
+
+RESOLVE_NODES = False # 合并后解析节点域名，按解析出的地址去重并过滤假节点
+RESOLVE_WORKERS = 64
+RESOLVE_DEADLINE = 60 # 解析全部域名的最长时间（秒），超时未解析的域名视为无法解析
+
+PROBE_NODES = False # 合并后测试每个节点能否连通，并按延迟排序输出
+PROBE_TLS = False # 对启用 TLS 的节点在 TCP 连接后再完成一次 TLS 握手
+PROBE_DROP_DEAD = False # 丢弃无法连通的节点
+
+IDENTITY_KEYS = frozenset(('type', 'server', 'port', 'network', 'sni', 'obfs-param',
+                           'ws-opts', 'h2-opts', 'grpc-opts', 'plugin-opts'))
 
 BANNED_WORDS = b64decodes('5rOV6L2uIOi9ruWtkCDova4g57uDIOawlCDlip8=').split()
+BANNED_RE = re.compile('|'.join([re.escape(_) for _ in BANNED_WORDS]))
 
 # !!! JUST FOR DEBUGING !!!
 DEBUG_NO_NODES = os.path.exists("local_NO_NODES")
@@ -89,18 +270,325 @@ DEBUG_NO_ADBLOCK = os.path.exists("local_NO_ADBLOCK")
 class UnsupportedType(Exception): pass
 class NotANode(Exception): pass
 
-session = requests.Session()
-session.trust_env = False
-if PROXY: session.proxies = {'http': PROXY, 'https': PROXY}
-session.headers["User-Agent"] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.58'
+def is_timeout(e: BaseException) -> bool:
+    # 流式读取中途的读取超时会被 requests 包装成 ConnectionError
+    if isinstance(e, (TimeoutError, requests.exceptions.Timeout)): return True
+    return isinstance(e, requests.exceptions.ConnectionError) and \
+        any(isinstance(_, ReadTimeoutError) for _ in e.args)
+
+@contextlib.contextmanager
+def wall_deadline(r: requests.Response, deadline: float) -> Iterator[None]:
+    # 读取超时只限制两次收到数据的间隔，服务器一点点发送时可以无限拖下去；
+    # 到达期限（time.monotonic()）时直接关闭连接，打断正在阻塞的读取，并按超时处理
+    expired = threading.Event()
+    sock = getattr(getattr(r.raw, '_connection', None), 'sock', None)
+    if sock is None:
+        # 不保持连接的响应（如 HTTP/1.0）读完头部后连接对象就不再持有套接字，只能从响应的文件对象中取得
+        fp = getattr(getattr(r.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    def stop() -> None:
+        expired.set()
+        try:
+            if sock is not None: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+    timer = threading.Timer(max(0, deadline - time.monotonic()), stop)
+    timer.daemon = True
+    timer.start()
+    try: yield
+    except Exception:
+        if expired.is_set(): raise TimeoutError
+        raise
+    finally: timer.cancel()
+    # 连接被关闭后读取可能正常结束，但内容并不完整
+    if expired.is_set(): raise TimeoutError
+
+class RateLimiter:
+    # 按主机限制请求速率：同一主机两次请求之间至少间隔 1/rate 秒，没有设置的主机不受限制
+    def __init__(self, rates: Dict[str, float]) -> None:
+        self.rates = rates
+        self.lock = threading.Lock()
+        self.next: Dict[str, float] = {}
+
+    def wait(self, host: Optional[str]) -> None:
+        rate = self.rates.get(host or '')
+        if not rate: return
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next.get(host, now))
+            self.next[host] = at + 1 / rate
+        if at > now: time.sleep(at - now)
+
+class CappedRetry(Retry):
+    # Retry-After 可能长达数分钟，而重试期间抓取线程一直被占用，所以等待时间不超过上限
+    def get_retry_after(self, response):
+        seconds = super().get_retry_after(response)
+        return None if seconds is None else min(seconds, SESSION_RETRY_AFTER_MAX)
+
+class PolicySession(requests.Session):
+    # 按主机应用重试、退避与限速策略，未指定 timeout 的请求使用 FETCH_TIMEOUT
+    def __init__(self, pool: int, policies: Dict[str, Dict[str, float]],
+                 retries: int, backoff: float) -> None:
+        super().__init__()
+        self.limiter = RateLimiter({h: p['rate'] for h, p in policies.items() if 'rate' in p})
+        adapter = self._adapter(pool, retries, backoff)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        for host, p in policies.items():
+            if 'retries' in p or 'backoff' in p:
+                adapter = self._adapter(pool, int(p.get('retries', retries)), p.get('backoff', backoff))
+                self.mount('http://'+host+'/', adapter)
+                self.mount('https://'+host+'/', adapter)
+
+    @staticmethod
+    def _adapter(pool: int, retries: int, backoff: float) -> HTTPAdapter:
+        retry = CappedRetry(total=retries, backoff_factor=backoff, status_forcelist=SESSION_RETRY_STATUS,
+                           raise_on_status=False, respect_retry_after_header=True)
+        return HTTPAdapter(pool_connections=pool, pool_maxsize=pool, max_retries=retry)
+
+    def request(self, method, url, *args, **kwargs):
+        self.limiter.wait(urlparse(url).hostname)
+        kwargs.setdefault('timeout', FETCH_TIMEOUT)
+        return super().request(method, url, *args, **kwargs)
+
+def make_session(pool: int = SESSION_POOL, policies: Dict[str, Dict[str, float]] = HOST_POLICIES,
+                 retries: int = SESSION_RETRIES, backoff: float = SESSION_BACKOFF) -> PolicySession:
+    # 所有抓取（订阅、机场列表、Adblock 列表及 dynamic.py）共用同一个会话，复用连接池
+    s = PolicySession(pool, policies, retries, backoff)
+    s.trust_env = False
+    if PROXY: s.proxies = {'http': PROXY, 'https': PROXY}
+    s.headers["User-Agent"] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.58'
+    return s
+
+session = make_session()
 
 exc_queue: List[str] = []
 
+class HTTPCache:
+    # 以 URL 为键的磁盘缓存，保存 ETag / Last-Modified 及响应内容，用于条件请求
+    def __init__(self, path: str, max_size: int = HTTP_CACHE_SIZE, max_age: int = HTTP_CACHE_MAX_AGE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.index: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(os.path.join(path, "index.json"), encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError): pass
+
+    def _file(self, url: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def headers(self, url: str) -> Dict[str, str]:
+        with self.lock:
+            entry = self.index.get(url)
+        if not entry or not os.path.exists(self._file(url)): return {}
+        ret = {}
+        if entry['etag']: ret['If-None-Match'] = entry['etag']
+        if entry['last_modified']: ret['If-Modified-Since'] = entry['last_modified']
+        return ret
+
+    def load(self, url: str) -> Optional[bytes]:
+        try:
+            with open(self._file(url), 'rb') as f: body = f.read()
+        except OSError: return None
+        with self.lock:
+            if url in self.index: self.index[url]['used'] = time.time()
+        return body
+
+    def digest(self, url: str) -> Optional[str]:
+        with self.lock:
+            entry = self.index.get(url)
+        return entry['digest'] if entry else None
+
+    def store(self, url: str, headers: Any, body: Union[bytes, bytearray], digest: Optional[str] = None) -> None:
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified: return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(url), 'wb') as f: f.write(body)
+        now = time.time()
+        with self.lock:
+            self.index[url] = {'etag': etag, 'last_modified': last_modified,
+                    'digest': digest or hashlib.sha256(body).hexdigest(), 'size': len(body),
+                    'stored': now, 'used': now}
+
+    def save(self) -> None:
+        # 先清除过期条目，再按最近使用时间淘汰，直到总大小不超过上限
+        if not self.index and not os.path.isdir(self.path): return
+        with self.lock:
+            now = time.time()
+            entries = sorted(self.index.items(), key=lambda _: _[1]['used'], reverse=True)
+            self.index = {}
+            total = 0
+            for url, entry in entries:
+                if now - entry['used'] > self.max_age: continue
+                if total + entry['size'] > self.max_size: continue
+                total += entry['size']
+                self.index[url] = entry
+            keep = {os.path.basename(self._file(_)) for _ in self.index}
+            os.makedirs(self.path, exist_ok=True)
+            for name in os.listdir(self.path):
+                if name not in keep and name != "index.json":
+                    os.remove(os.path.join(self.path, name))
+            tmp = os.path.join(self.path, "index.json.tmp")
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump(self.index, f)
+            os.replace(tmp, os.path.join(self.path, "index.json"))
+
+http_cache = HTTPCache(os.path.join(CACHE_DIR, "http"))
+
+def content_digest(content: Union[str, List[Any]]) -> str:
+    if isinstance(content, str): data = content.encode('utf-8')
+    else: data = '\n'.join(sorted(json.dumps(_, ensure_ascii=False, sort_keys=True, default=str)
+                                  for _ in content)).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+class NodeStore:
+    # 跨次运行保存的节点库：记录每个订阅的内容哈希与解析结果，内容未变化时直接复用，
+    # 同时按去重标识记录每个节点首次、最近出现的时间，来源订阅及最近一次生成的链接
+    def __init__(self, path: str, max_age: int = NODE_STORE_MAX_AGE, version: str = PARSE_VERSION) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.version = version # 与内容哈希一起作为解析结果的键
+        self.lock = threading.Lock()
+        self.db: Optional[sqlite3.Connection] = None
+        self.now = time.time()
+
+    def _open(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS sources (url TEXT PRIMARY KEY, digest TEXT,
+                    size INTEGER, records BLOB, last_seen REAL);
+                CREATE TABLE IF NOT EXISTS nodes (key TEXT PRIMARY KEY, type TEXT, url TEXT,
+                    sources TEXT, first_seen REAL, last_seen REAL);
+            ''')
+        return self.db
+
+    def records(self, url: str, digest: str) -> Optional[Tuple[int, List[Tuple]]]:
+        with self.lock:
+            try:
+                db = self._open()
+                row = db.execute("SELECT size, records FROM sources WHERE url=? AND digest=?",
+                                 (url, self.version+':'+digest)).fetchone()
+                if row is None: return None
+                db.execute("UPDATE sources SET last_seen=? WHERE url=?", (self.now, url))
+                return row[0], [tuple(_) for _ in json.loads(zlib.decompress(row[1]))]
+            except (sqlite3.Error, zlib.error, ValueError): return None
+
+    def put_source(self, url: str, digest: str, size: int, records: List[Tuple]) -> None:
+        # 日期、bytes、元组、非字符串键等经 JSON 往返后会变样，含有这些值的解析结果不保存，
+        # 否则复用时的输出会与重新解析时不同
+        try: text = json.dumps(records, ensure_ascii=False)
+        except (TypeError, ValueError): return
+        if [tuple(_) for _ in json.loads(text)] != records: return
+        blob = zlib.compress(text.encode('utf-8'))
+        with self.lock:
+            self._open().execute("INSERT OR REPLACE INTO sources VALUES (?,?,?,?,?)",
+                                 (url, self.version+':'+digest, size, blob, self.now))
+
+    def put_nodes(self, nodes: Iterable[Tuple[Tuple, str, str, List[str]]]) -> None:
+        rows = ((json.dumps(key, ensure_ascii=False, default=str), tp, url,
+                 json.dumps(sources, ensure_ascii=False), self.now, self.now)
+                for key, tp, url, sources in nodes)
+        with self.lock:
+            self._open().executemany('''INSERT INTO nodes VALUES (?,?,?,?,?,?)
+                ON CONFLICT(key) DO UPDATE SET url=excluded.url, sources=excluded.sources,
+                last_seen=excluded.last_seen''', rows)
+
+    def save(self) -> None:
+        if self.db is None: return
+        with self.lock:
+            expire = self.now - self.max_age
+            self.db.execute("DELETE FROM sources WHERE last_seen<?", (expire,))
+            self.db.execute("DELETE FROM nodes WHERE last_seen<?", (expire,))
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+node_store = NodeStore(os.path.join(CACHE_DIR, "nodes.db"))
+probe_cache = ProbeCache(os.path.join(CACHE_DIR, "probe.json"))
+
+class SourceHistory:
+    # 每个订阅的历史表现：成功率、抓取用时及去重后独有节点数（指数移动平均），以及连续失败次数；
+    # 据此决定抓取顺序、期限，以及是否暂时跳过
+    ALPHA = 0.3
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError): pass
+
+    def priority(self, key: str) -> Tuple[float, float]:
+        # 越小越先抓取：没有记录的订阅最先，其次按独有节点数从多到少，再按用时从短到长
+        entry = self.entries.get(key)
+        if entry is None: return (-float('inf'), 0)
+        return (-entry['unique'], entry['latency'] or 0)
+
+    def timeout(self, key: str) -> float:
+        entry = self.entries.get(key)
+        if entry is None or entry['runs'] < SOURCE_SKIP_AFTER: return FETCH_DEADLINE
+        if entry['unique'] < 1: return FETCH_DEADLINE_MIN
+        if entry['latency'] and entry['latency'] * 2 > FETCH_DEADLINE:
+            return min(entry['latency'] * 2, FETCH_DEADLINE_MAX)
+        return FETCH_DEADLINE
+
+    def skip(self, key: str) -> bool:
+        # 连续失败后按指数退避跳过，跳过足够次数后再试一次
+        entry = self.entries.get(key)
+        if entry is None or entry['fails'] < SOURCE_SKIP_AFTER: return False
+        backoff = min(2 ** (entry['fails'] - SOURCE_SKIP_AFTER), SOURCE_REPROBE_MAX)
+        if entry['skipped'] >= backoff: return False
+        entry['skipped'] += 1
+        return True
+
+    def record(self, key: str, ok: Optional[bool], latency: Optional[float], unique: int) -> None:
+        # ok 为 None 表示超时，不计入连续失败
+        entry = self.entries.setdefault(key, {'runs': 0, 'ok': 0, 'latency': None,
+                                              'unique': unique, 'fails': 0, 'skipped': 0})
+        a = __class__.ALPHA
+        entry['runs'] += 1
+        entry['skipped'] = 0
+        if ok: entry['ok'] += 1
+        if ok is False: entry['fails'] += 1
+        elif ok: entry['fails'] = 0
+        if latency is not None:
+            entry['latency'] = latency if entry['latency'] is None else \
+                round(a * latency + (1-a) * entry['latency'], 3)
+        entry['unique'] = round(a * unique + (1-a) * entry['unique'], 3)
+        entry['time'] = time.time()
+
+    def save(self) -> None:
+        now = time.time()
+        entries = {k: v for k, v in self.entries.items() if now - v.get('time', now) < NODE_STORE_MAX_AGE}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path+".tmp", 'w', encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(self.path+".tmp", self.path)
+
+source_history = SourceHistory(os.path.join(CACHE_DIR, "sources.json"))
+
 class Node:
+    # data 即节点的 Clash 配置；修改 data 后须调用 invalidate()（update() 会自动调用）
+    __slots__ = ('data', 'type', 'name', 'key', 'region', 'addr', 'rtt',
+                 '_url', '_clash', '_clash_ok', '_ray_ok')
     names: Set[str] = set()
+    name_counters: Dict[str, int] = {} # 每个重名名称下一次从哪个编号开始尝试
     DATA_TYPE = Dict[str, Any]
 
     def __init__(self, data: Union[DATA_TYPE, str]) -> None:
+        self._url: Optional[str] = None
+        self._clash: Optional[__class__.DATA_TYPE] = None
+        self._clash_ok: Optional[bool] = None
+        self._ray_ok: Optional[bool] = None
+        self.region: Optional[str] = None # 由 RegionClassifier 填写
+        self.addr: Optional[str] = None # 解析出的服务器地址，由 dedup_by_address 填写
+        self.rtt: Optional[float] = None # 连通性测试的延迟（毫秒），未测试或失败时为 None
         if isinstance(data, dict):
             self.data: __class__.DATA_TYPE = data
             self.type = data['type']
@@ -113,60 +601,84 @@ class Node:
             self.data['password'] = str(self.data['password'])
         self.data['type'] = self.type
         self.name: str = self.data['name']
+        self.key: Tuple = self._identity()
 
     def __str__(self):
         return self.url
 
-    def __hash__(self):
+    def _identity(self) -> Tuple:
+        # 去重用的键：协议、地址、端口及决定实际连接目标的传输参数
         data = self.data
         try:
-            path = ""
+            extra: Tuple = ()
             if self.type == 'vmess':
-                path = data['network']+':'
-                if data['network'] == 'ws':
-                    if 'ws-opts' in data:
-                        try:
-                            path += data['ws-opts']['headers']['Host']
-                        except KeyError: pass
-                        if 'path' in data['ws-opts']:
-                            path += '/'+data['ws-opts']['path']
-                elif data['network'] == 'h2':
-                    if 'h2-opts' in data:
-                        if 'host' in data['h2-opts']:
-                            path += ','.join(data['h2-opts']['host'])
-                        if 'path' in data['h2-opts']:
-                            path += '/'+data['h2-opts']['path']
-                elif data['network'] == 'grpc':
-                    if 'grpc-opts' in data:
-                        if 'grpc-service-name' in data['grpc-opts']:
-                            path += data['grpc-opts']['grpc-service-name']
+                net = data.get('network', 'tcp') # Clash 配置中省略时即为 tcp
+                if net == 'ws':
+                    opts = data.get('ws-opts', {})
+                    extra = (net, opts.get('headers', {}).get('Host'), opts.get('path'))
+                elif net == 'h2':
+                    opts = data.get('h2-opts', {})
+                    extra = (net, tuple(opts.get('host', ())), opts.get('path'))
+                elif net == 'grpc':
+                    extra = (net, data.get('grpc-opts', {}).get('grpc-service-name'))
+                else: extra = (net,)
             elif self.type == 'ss':
-                if 'plugin-opts' in data:
-                    opts = data['plugin-opts']
-                    if 'host' in opts:
-                        path = opts['host']
-                    if 'path' in opts:
-                        path += '/'+opts['path']
+                opts = data.get('plugin-opts', {})
+                extra = (opts.get('host'), opts.get('path'))
             elif self.type == 'ssr':
-                if 'obfs-param' in data:
-                    path = data['obfs-param']
+                extra = (data.get('obfs-param'),)
             elif self.type == 'trojan':
-                if 'sni' in data:
-                    path = data['sni']+':'
-                if data['network'] == 'ws':
-                    if 'ws-opts' in data:
-                        try:
-                            path += data['ws-opts']['headers']['Host']
-                        except KeyError: pass
-                        if 'path' in data['ws-opts']:
-                            path += '/'+data['ws-opts']['path']
-            hashstr = f"{self.type}:{data['server']}:{data['port']}:{path}"
-            return hash(hashstr)
-        except Exception: return hash('__ERROR__')
+                extra = (data.get('sni'), data.get('network'))
+                if data.get('network') == 'ws':
+                    opts = data.get('ws-opts', {})
+                    extra += (opts.get('headers', {}).get('Host'), opts.get('path'))
+            return (self.type, str(data['server']).lower(), str(data['port'])) + extra
+        except Exception:
+            # 缺少必要字段等异常情况：用全部数据作为键，不同的节点不会因此被合并
+            return ('__ERROR__', json.dumps(data, sort_keys=True, ensure_ascii=False, default=str))
+
+    def endpoint(self, tls: bool = False) -> Optional[Tuple[str, int, Optional[str]]]:
+        # 连通性测试的目标；tls 为真时，启用 TLS 的节点附带握手使用的 SNI
+        server = self.data.get('server')
+        if not server: return None
+        try: port = int(self.data['port'])
+        except (KeyError, TypeError, ValueError): return None
+        sni = None
+        if tls and (self.type == 'trojan' or self.data.get('tls')):
+            sni = self.data.get('sni') or self.data.get('servername') or str(server)
+        return self.addr or str(server).lower(), port, sni
+
+    def uses_hostname(self) -> bool:
+        # 服务器域名是否还参与连接：没有显式设置时，TLS 的 SNI 与 ws / h2 / http 伪装的 Host
+        # 都会使用服务器域名，此时解析到同一地址（如同一 CDN）的节点并不相同
+        data = self.data
+        try:
+            if (self.type == 'trojan' or data.get('tls')) and not (data.get('sni') or data.get('servername')):
+                return True
+            net = data.get('network')
+            if net == 'ws': return not (data.get('ws-opts') or {}).get('headers', {}).get('Host')
+            if net == 'h2': return not (data.get('h2-opts') or {}).get('host')
+            if net == 'http': return not (data.get('http-opts') or {}).get('headers', {}).get('Host')
+            if self.type == 'ss' and data.get('plugin'): return not (data.get('plugin-opts') or {}).get('host')
+            return False
+        except Exception: return True
+
+    def update(self, data: DATA_TYPE) -> None:
+        self.data.update(data)
+        self.invalidate()
+        if not IDENTITY_KEYS.isdisjoint(data):
+            self.key = self._identity()
+
+    def invalidate(self) -> None:
+        self._url = self._clash = None
+        self._clash_ok = self._ray_ok = None
+
+    def __hash__(self):
+        return hash(self.key)
     
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return hash(self) == hash(other)
+            return self.key == other.key
         else:
             return False
 
@@ -292,18 +804,17 @@ class Node:
         else: raise UnsupportedType(self.type)
 
     def format_name(self, max_len=30) -> None:
-        self.data['name'] = self.name
-        for word in BANNED_WORDS:
-            self.data['name'] = self.data['name'].replace(word, '*'*len(word))
-        if len(self.data['name']) > max_len:
-            self.data['name'] = self.data['name'][:max_len]+'...'
-        if self.data['name'] in Node.names:
-            i = 0
-            new: str = self.data['name']
-            while new in Node.names:
-                i += 1
-                new = f"{self.data['name']} #{i}"
-            self.data['name'] = new
+        self.invalidate()
+        name = BANNED_RE.sub(lambda m: '*'*len(m.group()), self.name)
+        if len(name) > max_len:
+            name = name[:max_len]+'...'
+        if name in Node.names:
+            # Node.names 只增不减，已被占用的编号之后不会再空出来
+            i = Node.name_counters.get(name, 1)
+            while f"{name} #{i}" in Node.names: i += 1
+            Node.name_counters[name] = i
+            name = f"{name} #{i}"
+        self.data['name'] = name
         
     @property
     def isfake(self) -> bool:
@@ -320,6 +831,10 @@ class Node:
 
     @property
     def url(self) -> str:
+        if self._url is None: self._url = self._render_url()
+        return self._url
+
+    def _render_url(self) -> str:
         data = self.data
         if self.type == 'vmess':
             v = VMESS_EXAMPLE.copy()
@@ -391,9 +906,12 @@ class Node:
 
     @property
     def clash_data(self) -> DATA_TYPE:
+        # 返回的字典会被缓存复用，请勿修改
+        if self._clash is None: self._clash = self._render_clash()
+        return self._clash
+
+    def _render_clash(self) -> DATA_TYPE:
         ret = self.data.copy()
-        if 'password' in ret and ret['password'].isdigit():
-            ret['password'] = '!!str '+ret['password']
         if 'uuid' in ret and len(ret['uuid']) != len(DEFAULT_UUID):
             ret['uuid'] = DEFAULT_UUID
         if 'group' in ret: del ret['group']
@@ -402,10 +920,16 @@ class Node:
         return ret
 
     def supports_clash(self) -> bool:
+        if self._clash_ok is None: self._clash_ok = self._check_clash()
+        return self._clash_ok
+
+    def _check_clash(self) -> bool:
         if self.isfake: return False
         if 'network' in self.data and self.data['network'] in ('h2','grpc'):
             # A quick fix for #2
-            self.data['tls'] = True
+            if self.data.get('tls') is not True:
+                self.data['tls'] = True
+                self.invalidate()
         if self.type == 'vless': return False
         if self.data['type'] == 'vless': return False
         if 'cipher' not in self.data: return True
@@ -427,6 +951,10 @@ class Node:
         return True
 
     def supports_ray(self) -> bool:
+        if self._ray_ok is None: self._ray_ok = self._check_ray()
+        return self._ray_ok
+
+    def _check_ray(self) -> bool:
         if self.isfake: return False
         # if self.type == 'ss':
         #     if 'plugin' in self.data and self.data['plugin']: return False
@@ -434,6 +962,144 @@ class Node:
         #     return False
         return True
 
+class Sniffer:
+    # 流式判断订阅格式：Clash 配置只保留 proxies 段，遇到后续段落即停止读取
+    STOP_KEYS = (b"proxy-groups:", b"rules:", b"script:")
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+        self.tp: Optional[str] = None # 'yaml' / 'sub' / 'raw'
+        self.pos = 0    # 下一行的起始位置
+        self.scan = 0   # 查找换行符的起始位置，之前的部分已确认没有换行符
+        self.start = -1 # 'proxies:' 所在行的起始位置
+        self.end = -1   # 提前结束的位置
+
+    def feed(self, chunk: bytes) -> bool:
+        # 返回 True 表示已经不需要继续读取了
+        self.buf += chunk
+        if self.tp == 'yaml' and self.start >= 0:
+            return self._find_stop()
+        if self.tp in ('sub', 'raw'): return False
+        while self.tp is None or (self.tp == 'yaml' and self.start < 0):
+            nl = self.buf.find(b'\n', max(self.pos, self.scan))
+            if nl < 0:
+                self.scan = len(self.buf)
+                return False
+            self._line(self.pos, nl)
+            self.pos = nl + 1
+        if self.tp == 'yaml' and self.start >= 0:
+            return self._find_stop()
+        return False
+
+    def _line(self, begin: int, end: int) -> None:
+        line = bytes(memoryview(self.buf)[begin:end]).rstrip()
+        if not line: return
+        if self.tp is None:
+            if line == b"proxies:": self.tp = 'yaml'
+            elif b': ' in line:
+                kv = line.split(b': ')
+                if len(kv) == 2 and kv[0].isalpha():
+                    self.tp = 'yaml'
+            elif line[:1] == b'#': pass
+            elif b'://' in line: self.tp = 'raw'
+            else: self.tp = 'sub'
+        if self.tp == 'yaml' and self.start < 0 and line == b"proxies:":
+            self.start = begin
+
+    def _find_stop(self) -> bool:
+        # 只有顶格的段落名才会结束 proxies 段，因此直接查找 '\n' + 段落名
+        buf = self.buf
+        limit = buf.rfind(b'\n', max(self.pos, self.scan))
+        self.scan = len(buf)
+        if limit < 0: return self.end >= 0
+        for key in self.STOP_KEYS:
+            pos = buf.find(b'\n'+key, self.pos-1, limit)
+            while pos >= 0:
+                nl = buf.find(b'\n', pos+1)
+                if not buf[pos+1+len(key):nl].strip():
+                    if self.end < 0 or pos+1 < self.end: self.end = pos+1
+                    break
+                pos = buf.find(b'\n'+key, nl, limit)
+        self.pos = limit + 1
+        return self.end >= 0
+
+    def result(self) -> str:
+        if self.tp is None and self.pos < len(self.buf):
+            self._line(self.pos, len(self.buf))
+        if self.tp == 'yaml':
+            if self.start < 0: return ""
+            end = self.end if self.end >= 0 else len(self.buf)
+            return self.buf[self.start:end].decode(errors='ignore').replace('\\r','')
+        return self.buf.decode(errors='ignore')
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def yaml_load(stream: Union[str, TextIO]) -> Any:
+    return yaml.load(stream, Loader=YAML_LOADER)
+
+class YAMLFallback(Exception): pass
+
+YAML_STR_TAG = 'tag:yaml.org,2002:str'
+YAML_MAP_TAGS = (None, '!', 'tag:yaml.org,2002:map')
+YAML_SEQ_TAGS = (None, '!', 'tag:yaml.org,2002:seq')
+
+def yaml_load_plain(text: str) -> Any:
+    # 直接由解析事件构造 dict / list，省去节点树和构造器的开销，结果与 SafeLoader 一致；
+    # 遇到锚点、合并键或其它标签时抛出 YAMLFallback，交给 yaml_load 处理
+    resolver = yaml.resolver.Resolver()
+    constructor = yaml.constructor.SafeConstructor()
+    stack: List[list] = [] # [容器, 等待中的键]
+    root: List[Any] = []
+    nokey = object()
+    def add(value: Any) -> None:
+        if not stack: root.append(value); return
+        top = stack[-1]
+        if isinstance(top[0], list): top[0].append(value)
+        elif top[1] is nokey:
+            if isinstance(value, (dict, list)): raise YAMLFallback
+            top[1] = value
+        else:
+            top[0][top[1]] = value
+            top[1] = nokey
+    for event in yaml.parse(text, Loader=YAML_LOADER):
+        cls = event.__class__
+        if cls is yaml.ScalarEvent:
+            if event.anchor: raise YAMLFallback
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = resolver.resolve(yaml.ScalarNode, event.value, event.implicit)
+            if tag == YAML_STR_TAG: add(event.value)
+            else:
+                ctor = constructor.yaml_constructors.get(tag)
+                if ctor is None or tag == 'tag:yaml.org,2002:merge': raise YAMLFallback
+                add(ctor(constructor, yaml.ScalarNode(tag, event.value)))
+        elif cls is yaml.MappingStartEvent:
+            if event.anchor or event.tag not in YAML_MAP_TAGS: raise YAMLFallback
+            stack.append([{}, nokey])
+        elif cls is yaml.SequenceStartEvent:
+            if event.anchor or event.tag not in YAML_SEQ_TAGS: raise YAMLFallback
+            stack.append([[], nokey])
+        elif cls is yaml.MappingEndEvent or cls is yaml.SequenceEndEvent:
+            add(stack.pop()[0])
+        elif cls is yaml.AliasEvent: raise YAMLFallback
+    if len(root) > 1: raise YAMLFallback # 多个文档
+    return root[0] if root else None
+
+def load_proxies(text: str) -> List[Node.DATA_TYPE]:
+    # 只需要 proxies 段：嗅探器通常已经截取好了，否则（如动态抓取的内容）先截取再解析
+    if not text.startswith("proxies:"):
+        sniffer = Sniffer()
+        sniffer.feed(text.encode('utf-8'))
+        section = sniffer.result()
+        if section.startswith("proxies:"): text = section
+    text = text.replace("!<str>","!!str")
+    try: config = yaml_load_plain(text)
+    except YAMLFallback: config = yaml_load(text)
+    # proxies 段为空（或整个配置不是映射）时按空订阅处理
+    proxies = config.get('proxies') if isinstance(config, dict) else None
+    if not isinstance(proxies, list): return []
+    return [_ for _ in proxies if isinstance(_, dict)]
+
 class Source():
     def __init__(self, url: Union[str, function]) -> None:
         if isinstance(url, function):
@@ -448,6 +1114,33 @@ class Source():
             self.url_source: None = None
         self.content: Union[str, List[str], int] = None
         self.sub: list = None
+        self.size: int = 0
+        self.digest: Optional[str] = None
+        self.records: Optional[List[Tuple]] = None
+        # 运行报告中的统计：status / bytes / latency / parse_time / nodes / unique
+        self.stats: Dict[str, Any] = {}
+        self.duplicate_of: Optional[int] = None # 与该序号的订阅内容相同，没有重复合并
+        self.timeout: float = FETCH_DEADLINE
+        self.skipped = False
+        self.deadline: Optional[float] = None
+        self.abandoned = False # 超过期限被抓取引擎放弃；之后 get() 即使完成，结果也不再使用
+
+    @property
+    def history_key(self) -> str:
+        # 带 '+' 标记的链接每天都会变化，用原始写法作为历史记录的键
+        return self.url_source if isinstance(self.url_source, str) else self.url
+
+    def schedule(self) -> bool:
+        # 按历史表现设定期限；返回 False 表示本次跳过
+        self.timeout = source_history.timeout(self.history_key)
+        self.skipped = source_history.skip(self.history_key)
+        if self.skipped: self.stats['status'] = 'skipped'
+        return not self.skipped
+
+    @property
+    def host(self) -> str:
+        if self.url.startswith("dynamic:"): return self.url
+        return urlparse(self.url).hostname or self.url
 
     def gen_url(self) -> None:
         self.url_source: str
@@ -464,14 +1157,25 @@ class Source():
     def get(self, depth=2) -> None:
         global exc_queue
         if self.content: return
+        self.deadline = time.monotonic() + self.timeout
         try:
             if self.url.startswith("dynamic:"):
                 content: Union[str, List[str]] = self.url_source()
             else:
                 global session
                 content: str = ""
-                with session.get(self.url, stream=True) as r:
-                    if r.status_code != 200:
+                with session.get(self.url, stream=True, timeout=FETCH_TIMEOUT,
+                                 headers=http_cache.headers(self.url)) as r:
+                    if r.status_code == 304:
+                        body = http_cache.load(self.url)
+                        if body is None: raise requests.exceptions.RequestException("缓存丢失")
+                        self.digest = http_cache.digest(self.url)
+                        self.stats.update(status=304, bytes=len(body))
+                        sniffer = Sniffer()
+                        sniffer.feed(body)
+                        content = sniffer.result()
+                    elif r.status_code != 200:
+                        self.stats['status'] = r.status_code
                         if depth > 0 and isinstance(self.url_source, str):
                             exc = f"'{self.url}' 抓取时 {r.status_code}"
                             self.gen_url()
@@ -481,51 +1185,36 @@ class Source():
                         else:
                             self.content = r.status_code
                         return
-                    tp = None
-                    pending = None
-                    early_stop = False
-                    for chunk in r.iter_content():
-                        if early_stop: pending = None; break
-                        chunk: bytes
-                        if pending is not None:
-                            chunk = pending + chunk
-                            pending = None
-                        if tp == 'sub':
-                            content += chunk.decode(errors='ignore')
-                            continue
-                        lines: List[bytes] = chunk.splitlines()
-                        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
-                            pending = lines.pop()
-                        while lines:
-                            line = lines.pop(0).rstrip().decode(errors='ignore').replace('\\r','')
-                            if not line: continue
-                            if not tp:
-                                if ': ' in line:
-                                    kv = line.split(': ')
-                                    if len(kv) == 2 and kv[0].isalpha():
-                                        tp = 'yaml'
-                                elif line[0] == '#': pass
-                                else: tp = 'sub'
-                            if tp == 'yaml':
-                                if content:
-                                    if line in ("proxy-groups:", "rules:", "script:"):
-                                        early_stop=True; break
-                                    content += line+'\n'
-                                elif line == "proxies:":
-                                    content = line+'\n'
-                            elif tp == 'sub':
-                                content = chunk.decode(errors='ignore')
-                    if pending is not None: content += pending.decode(errors='ignore')
+                    else:
+                        sniffer = Sniffer()
+                        hasher = hashlib.sha256()
+                        # 按墙上时间限制整个下载过程，慢速滴灌的服务器也会在期限到达时被断开
+                        with wall_deadline(r, self.deadline):
+                            for chunk in r.iter_content(FETCH_CHUNK_SIZE):
+                                stop = sniffer.feed(chunk)
+                                hasher.update(chunk)
+                                if stop: break
+                        # 提前结束时只缓存已读取的部分，再次解析的结果是一样的
+                        self.digest = hasher.hexdigest()
+                        self.stats.update(status=200, bytes=len(sniffer.buf))
+                        http_cache.store(self.url, r.headers, sniffer.buf, self.digest)
+                        content = sniffer.result()
         except KeyboardInterrupt: raise
-        except requests.exceptions.RequestException:
-            self.content = -1
+        except (TimeoutError, requests.exceptions.Timeout):
+            self.content = -3
+        except requests.exceptions.RequestException as e:
+            self.content = -3 if is_timeout(e) else -1
         except:
             self.content = -2
             exc = "在抓取 '"+self.url+"' 时发生错误：\n"+traceback.format_exc()
             exc_queue.append(exc)
         else:
             self.content: Union[str, List[str]] = content
-            self.parse()
+            if self.digest is None: self.digest = content_digest(content)
+            # 订阅内容与上次相同时直接使用节点库中保存的解析结果
+            stored = node_store.records(self.url, self.digest)
+            if stored: self.size, self.records = stored
+            else: self.parse()
 
     def parse(self) -> None:
         global exc_queue
@@ -534,8 +1223,7 @@ class Source():
             if isinstance(text, str):
                 if "proxies:" in text:
                     # Clash config
-                    config = yaml.full_load(text.replace("!<str>","!!str"))
-                    sub: List[str] = config['proxies']
+                    sub: List[Node.DATA_TYPE] = load_proxies(text)
                 elif '://' in text:
                     # V2Ray raw list
                     sub = text.strip().splitlines()
@@ -544,56 +1232,309 @@ class Source():
                     sub = b64decodes(text.strip()).strip().splitlines()
             else: sub = text # 动态节点抓取后直接传入列表
             self.sub = sub
+            self.size = len(sub)
         except KeyboardInterrupt: raise
         except: exc_queue.append(
                 "在解析 '"+self.url+"' 时发生错误：\n"+traceback.format_exc())
 
+class Fetcher:
+    # 有界并发的抓取引擎：同时最多抓取 workers 个订阅，同一主机最多 per_host 个，按完成顺序交付
+    def __init__(self, workers: int = FETCH_WORKERS, per_host: int = FETCH_PER_HOST,
+                 backlog: int = FETCH_BACKLOG, window: int = MERGE_WINDOW) -> None:
+        self.per_host = per_host
+        self.window = window
+        self.open: Set[Source] = set() # 已开始抓取但尚未合并的订阅，合并后由 retire() 移除
+        self.urgent: Callable[[Source], bool] = lambda _: False # 是否为下一个要合并的订阅
+        self.cond = threading.Condition()
+        self.waiting: List[Tuple[int, Source]] = []
+        self.running: Dict[int, Tuple[Source, str]] = {}
+        self.hosts: Dict[str, int] = {}
+        # 有界队列：结果没有被及时取走时，抓取线程会停下来等待
+        self.done: "queue.Queue[Tuple[int, Source, bool]]" = queue.Queue(backlog)
+        self.expired: List[Tuple[int, Source, bool]] = []
+        self.total = 0
+        self.holds = 0 # 还可能提交新任务的生产者数量，不为零时 results() 不会结束
+        for _ in range(workers): self._spawn()
+
+    def _spawn(self) -> None:
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, sourceId: int, source: Source) -> None:
+        with self.cond:
+            self.waiting.append((sourceId, source))
+            self.total += 1
+            self.cond.notify()
+
+    def hold(self) -> None:
+        with self.cond: self.holds += 1
+
+    def release(self) -> None:
+        with self.cond: self.holds -= 1
+        self.done.put(None) # 唤醒 results()
+
+    def _take(self) -> Tuple[int, Source, str]:
+        with self.cond:
+            while True:
+                # 合并阶段跟不上时只放行它正在等待的订阅，避免结果在内存中无限堆积
+                full = len(self.open) >= self.window
+                for k, (i, source) in enumerate(self.waiting):
+                    if full and not self.urgent(source): continue
+                    host = source.host
+                    if self.hosts.get(host, 0) < self.per_host:
+                        del self.waiting[k]
+                        self.open.add(source)
+                        self.hosts[host] = self.hosts.get(host, 0) + 1
+                        self.running[i] = (source, host)
+                        return i, source, host
+                self.cond.wait()
+
+    def _release(self, host: str) -> None:
+        self.hosts[host] -= 1
+        self.cond.notify_all()
+
+    def retire(self, source: Optional[Source] = None) -> None:
+        # 合并阶段处理完一个订阅（包括跳过的），让出名额；下一个要合并的订阅也随之改变。
+        # 机场列表中的订阅分配序号后也要调用一次，它可能正是合并阶段在等待的订阅
+        with self.cond:
+            self.open.discard(source)
+            self.cond.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            i, source, host = self._take()
+            start = time.monotonic()
+            try: source.get()
+            finally:
+                source.stats['latency'] = round(time.monotonic() - start, 3)
+                with self.cond:
+                    # 已被判定为超时的任务由替补线程接手，本线程直接退出
+                    if self.running.pop(i, None) is None: return
+                    self._release(host)
+            self.done.put((i, source, True))
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        with self.cond:
+            for i, (source, host) in list(self.running.items()):
+                if source.deadline is not None and now > source.deadline + FETCH_TIMEOUT[1]:
+                    del self.running[i]
+                    source.abandoned = True
+                    self._release(host)
+                    self._spawn()
+                    self.expired.append((i, source, False))
+
+    def results(self) -> Iterator[Optional[Tuple[int, Source, bool]]]:
+        # 第三项为 False 表示该订阅超过期限仍未完成，已被放弃；生产者结束时产生一个 None
+        finished = 0
+        while finished < self.total or self.holds:
+            if self.expired:
+                finished += 1
+                yield self.expired.pop(0)
+                continue
+            try: item = self.done.get(timeout=1)
+            except queue.Empty:
+                self._expire()
+                continue
+            if item is not None: finished += 1
+            yield item
+
 class DomainTree:
+    # 以域名各级标签倒序组成的树，父域名已被拦截时忽略其所有子域名
+    __slots__ = ('children', 'here')
+
     def __init__(self) -> None:
-        self.children: Dict[str, __class__] = {}
+        self.children: Optional[Dict[str, DomainTree]] = None # 叶子节点不分配字典
         self.here: bool = False
 
     def insert(self, domain: str) -> None:
-        segs = domain.split('.')
-        segs.reverse()
-        self._insert(segs)
+        node = self
+        for seg in reversed(domain.split('.')):
+            if node.here: return
+            if node.children is None: node.children = {}
+            child = node.children.get(seg)
+            if child is None:
+                child = node.children[sys.intern(seg)] = DomainTree()
+            node = child
+        node.here = True
+        node.children = None
 
-    def _insert(self, segs: List[str]) -> None:
-        if not segs:
-            self.here = True
-            return
-        if self.here: return
-        if segs[0] not in self.children:
-            self.children[segs[0]] = __class__()
-        child = self.children[segs[0]]
-        del segs[0]
-        child._insert(segs)
+    def iter_suffixes(self) -> Iterator[str]:
+        if not self.children: return
+        stack = [(iter(self.children.items()), '')]
+        while stack:
+            it, suffix = stack[-1]
+            for name, child in it:
+                if child.here: yield name+suffix
+                elif child.children:
+                    stack.append((iter(child.children.items()), '.'+name+suffix))
+                    break
+            else: stack.pop()
 
     def get(self) -> List[str]:
-        ret: List[str] = []
-        for name, child in self.children.items():
-            if child.here: ret.append(name)
-            else: ret.extend([_+'.'+name for _ in child.get()])
-        return ret
+        return list(self.iter_suffixes())
+
+class KeywordMatcher:
+    # Aho-Corasick 自动机：只需扫描一遍文本，就能找出其中出现的所有关键词
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.out: List[Tuple[str, ...]] = [()]
+        for key in keywords:
+            if not key: continue
+            state = 0
+            for ch in key:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.out.append(())
+                state = nxt
+            if key not in self.out[state]:
+                self.out[state] += (key,)
+        # 按层构造失配指针，并把失配后的转移直接补进 goto，扫描时无需回溯
+        self.fail: List[int] = [0] * len(self.goto)
+        order = list(self.goto[0].values())
+        for state in order:
+            for ch, nxt in self.goto[state].items():
+                order.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+        self.delta: List[Dict[str, int]] = [dict(_) for _ in self.goto]
+        for state in order:
+            for ch, nxt in self.delta[self.fail[state]].items():
+                self.delta[state].setdefault(ch, nxt)
+        self.final = [bool(_) for _ in self.out]
 
-def extract(url: str) -> Union[Set[str], int]:
+    def search(self, text: str) -> bool:
+        # 文本中是否出现了任意一个关键词
+        delta = self.delta
+        final = self.final
+        state = 0
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if final[state]: return True
+        return False
+
+    def findall(self, text: str) -> Set[str]:
+        delta = self.delta
+        out = self.out
+        found: Set[str] = set()
+        state = 0
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if out[state]: found.update(out[state])
+        return found
+
+class RegionClassifier:
+    # 由 snippets/_config.yml 中 categories 编译出的地区分类器，每个节点名只需扫描一遍
+    def __init__(self, categories: Dict[str, List[str]]) -> None:
+        self.order = list(categories)
+        # 以 OVERALL 结尾的分类：只要在它之前（含它自己）已经命中，就不再继续匹配后面的分类
+        self.overall = {ctg for ctg, keys in categories.items() if keys and keys[-1] == 'OVERALL'}
+        self.owners: Dict[str, List[str]] = {}
+        for ctg, keys in categories.items():
+            for key in keys:
+                self.owners.setdefault(str(key), []).append(ctg)
+        self.matcher = KeywordMatcher(self.owners)
+
+    def classify(self, name: str) -> List[str]:
+        hit: Set[str] = set()
+        for key in self.matcher.findall(name): hit.update(self.owners[key])
+        ctgs: List[str] = []
+        for ctg in self.order:
+            if ctg in hit: ctgs.append(ctg)
+            if ctgs and ctg in self.overall: break
+        return ctgs
+
+def extract(url: str, found: Optional[Callable[[str], None]] = None) -> Union[List[str], int]:
+    # 边下载边逐行查找订阅链接，每找到一个就交给 found；返回找到的全部链接，或失败时的状态码
     global session
-    res = session.get(url)
-    if res.status_code != 200: return res.status_code
-    urls = set()
-    for line in res.text:
-        if line.startswith("http"):
-            urls.add(line)
+    deadline = time.monotonic() + AIRPORT_DEADLINE
+    urls: List[str] = []
+    with session.get(url, stream=True, timeout=FETCH_TIMEOUT) as r, wall_deadline(r, deadline):
+        if r.status_code != 200: return r.status_code
+        for line in r.iter_lines(FETCH_CHUNK_SIZE):
+            line = line.decode('utf-8', errors='ignore').strip()
+            if line.startswith("http"):
+                urls.append(line)
+                if found: found(line)
     return urls
 
-merged: Dict[str, Node] = {}
+class AirportExpander:
+    # 并发展开机场列表，发现的订阅立即交给抓取引擎；订阅序号则按机场列表的顺序（其次按链接在
+    # 列表中的顺序）在列表读取完毕后依次分配，保证结果与完成的先后无关
+    def __init__(self, airports: List[str], fetcher: Fetcher, ids: Dict[Source, int],
+                 skip: Set[str], workers: int = AIRPORT_WORKERS) -> None:
+        self.airports = airports
+        self.fetcher = fetcher
+        self.ids = ids # 已分配的订阅序号，与主程序共用
+        self.skip = skip # 已在订阅列表中的链接
+        self.lock = threading.Lock()
+        self.known: Dict[str, Source] = {}
+        self.found: List[List[str]] = [[] for _ in airports]
+        self.key = len(ids) # 交给抓取引擎的临时编号，不与已有序号冲突
+        self.next = 0
+        self.started = self.finished = time.monotonic() # 最后一个机场列表读取完毕的时间
+        self.pool = ThreadPoolExecutor(workers)
+        self.futures: List[Future] = []
+        for k, url in enumerate(airports):
+            fetcher.hold()
+            self.futures.append(self.pool.submit(self._run, k, url))
+        self.pool.shutdown(wait=False)
+
+    def _run(self, k: int, url: str) -> Union[List[str], int]:
+        try: return extract(url, lambda _: self._found(k, _))
+        finally:
+            with self.lock: self.finished = max(self.finished, time.monotonic())
+            self.fetcher.release()
+
+    @property
+    def elapsed(self) -> float:
+        return self.finished - self.started
+
+    def _found(self, k: int, url: str) -> None:
+        url = canonical_url(url)
+        with self.lock:
+            self.found[k].append(url)
+            if url in self.skip or url in self.known: return
+            source = self.known[url] = Source(url)
+            key = self.key
+            self.key += 1
+        if source.schedule(): self.fetcher.submit(key, source)
+
+    def finalize(self, sources_obj: List[Source], block: bool = False) -> Iterator[Tuple[int, Source]]:
+        # 依次处理已经读取完毕的机场列表，为其中新出现的订阅分配序号；block 为真时等待全部读取完毕
+        if block: wait(self.futures)
+        while self.next < len(self.futures) and self.futures[self.next].done():
+            k = self.next
+            self.next += 1
+            try: res = self.futures[k].result()
+            except (TimeoutError, requests.exceptions.Timeout): status = "超时！"
+            except requests.exceptions.RequestException as e:
+                status = "超时！" if is_timeout(e) else "抓取失败！"
+            except Exception:
+                status = "错误！"
+                exc_queue.append("在抓取 '"+self.airports[k]+"' 时发生错误：\n"+traceback.format_exc())
+            else: status = str(res) if isinstance(res, int) else f"完成！共 {len(res)} 个链接"
+            print("展开机场 '"+self.airports[k]+"'... "+status+'\n', end='', flush=True)
+            with self.lock: found = self.found[k]
+            for url in found:
+                source = self.known.get(url)
+                if source is None or source in self.ids: continue
+                self.ids[source] = len(sources_obj)
+                sources_obj.append(source)
+                yield self.ids[source], source
+
+merged: Dict[Tuple, Node] = {}
 unknown: Set[str] = set()
-used: Dict[int, Dict[int, str]] = {}
-def merge(source_obj: Source, sourceId=-1) -> None:
-    global merged, unknown
-    sub = source_obj.sub
-    if not sub: print("空订阅，跳过！", end='', flush=True); return
-    for p in sub:
+used: Dict[Tuple, Dict[int, str]] = {}
+def parse_nodes(lines: List[Union[str, Node.DATA_TYPE]]) -> List[Tuple]:
+    # 在解析进程中运行，只做与全局状态无关的部分，结果交回主进程合并：
+    # ('node', data) / ('unknown', 原始行, 提示信息) / ('error', 错误信息)
+    ret: List[Tuple] = []
+    for p in lines:
         if isinstance(p, str):
             if not p.isascii() or '://' not in p: continue
             ok = True
@@ -604,20 +1545,202 @@ def merge(source_obj: Source, sourceId=-1) -> None:
         try: n = Node(p)
         except KeyboardInterrupt: raise
         except UnsupportedType as e:
-            if len(e.args) == 1:
-                print(f"不支持的类型：{e}")
-            unknown.add(p)
-        except: traceback.print_exc()
+            ret.append(('unknown', p, f"不支持的类型：{e}" if len(e.args) == 1 else None))
+        except: ret.append(('error', traceback.format_exc()))
+        else: ret.append(('node', n.data))
+    return ret
+
+def parse_batch(lines: List[Union[str, Node.DATA_TYPE]]) -> Tuple[List[Tuple], float]:
+    # 在解析进程中运行，同时返回解析用时
+    start = time.perf_counter()
+    return parse_nodes(lines), time.perf_counter() - start
+
+def submit_parse(pool: ProcessPoolExecutor, sub: Iterable[Union[str, Node.DATA_TYPE]],
+                 slots: Optional[threading.Semaphore] = None) -> List[Future]:
+    # 给出 slots 时，每个批次占用一个名额直至解析完成，名额用尽时在此等待
+    sub = list(sub)
+    ret: List[Future] = []
+    for i in range(0, len(sub), PARSE_BATCH):
+        if slots is not None: slots.acquire()
+        fut = pool.submit(parse_batch, sub[i:i+PARSE_BATCH])
+        if slots is not None: fut.add_done_callback(lambda _: slots.release())
+        ret.append(fut)
+    return ret
+
+def merge(source_obj: Source, sourceId=-1, records: Optional[List[Tuple]] = None) -> bool:
+    # 返回 False 表示空订阅
+    global merged, unknown
+    if not source_obj.size: return False
+    if records is None: records = parse_nodes(source_obj.sub)
+    nodes = unique = 0
+    for record in records:
+        if record[0] == 'unknown':
+            if record[2]: print(record[2])
+            unknown.add(record[1])
+            continue
+        if record[0] == 'error':
+            print(record[1], file=sys.stderr, end='')
+            continue
+        n = Node(record[1])
+        n.format_name()
+        Node.names.add(n.data['name'])
+        key = n.key
+        nodes += 1
+        if key not in merged:
+            unique += 1
+            merged[key] = n
         else:
-            n.format_name()
-            Node.names.add(n.data['name'])
-            if hash(n) not in merged:
-                merged[hash(n)] = n
-            else:
-                merged[hash(n)].data.update(n.data)
-            if hash(n) not in used:
-                used[hash(n)] = {}
-            used[hash(n)][sourceId] = n.name
+            merged[key].update(n.data)
+        if key not in used:
+            used[key] = {}
+        used[key][sourceId] = n.name
+    source_obj.stats.update(nodes=nodes, unique=unique)
+    return True
+
+class Merger:
+    # 合并阶段：在单独的线程中按订阅序号重新排序后依次合并，保证结果与抓取完成的先后无关；
+    # 合并会修改全局状态，所以只用一个线程
+    def __init__(self, fetcher: Fetcher, backlog: int = MERGE_BACKLOG) -> None:
+        self.fetcher = fetcher
+        self.queue: "queue.Queue[Optional[Tuple[int, Source, Optional[List[Future]]]]]" = queue.Queue(backlog)
+        self.pending: Dict[int, Tuple[Source, Optional[List[Future]]]] = {}
+        self.next = 0
+        self.digests: Dict[str, int] = {} # 已合并的内容哈希 -> 订阅序号
+        # 内容哈希 -> (解析任务, 缓存的解析结果)，内容相同的订阅只解析一次；合并后清空，不再占用内存
+        self.parsed: Dict[str, Tuple[List[Future], Optional[List[Tuple]]]] = {}
+        # 运行报告中的阶段耗时：各批次解析用时之和，及合并线程中 merge() 的用时之和（秒）
+        self.parse_time = 0.0
+        self.merge_time = 0.0
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def put(self, sourceId: int, source: Source, futures: Optional[List[Future]]) -> None:
+        # futures 为 None 表示该订阅抓取失败，只占住序号
+        self.queue.put((sourceId, source, futures))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def _work(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            self.pending[item[0]] = item[1:]
+            while self.next in self.pending:
+                source, futures = self.pending.pop(self.next)
+                if futures is not None: self._merge(self.next, source, futures)
+                self.next += 1
+                self.fetcher.retire(source)
+
+    def _merge(self, sourceId: int, source: Source, futures: List[Future]) -> None:
+        # 只有合并成功且非空的订阅才登记哈希，空内容或解析失败的订阅哈希相同也不算重复
+        if source.size and source.digest in self.digests:
+            source.duplicate_of = self.digests[source.digest]
+            print("合并 '"+source.url+f"'... 与订阅 {source.duplicate_of} 内容相同，跳过！\n", end='', flush=True)
+            source.sub = source.records = None
+            return
+        ok = False
+        try:
+            if source.records is None:
+                source.records = []
+                parse_time = 0.0
+                for fut in futures:
+                    records, elapsed = fut.result()
+                    source.records.extend(records)
+                    parse_time += elapsed
+                source.stats['parse_time'] = round(parse_time, 3)
+                self.parse_time += parse_time
+                node_store.put_source(source.url, source.digest, source.size, source.records)
+            start = time.monotonic()
+            try: ok = merge(source, sourceId=sourceId, records=source.records)
+            finally: self.merge_time += time.monotonic() - start
+        except KeyboardInterrupt: raise
+        except:
+            print("合并 '"+source.url+"'... 失败！\n"+traceback.format_exc(), end='', flush=True)
+        else:
+            # 与抓取阶段的输出交错，整行一次写出
+            print("合并 '"+source.url+"'... "+("完成！" if ok else "空订阅，跳过！")+'\n', end='', flush=True)
+        source.sub = source.records = None # 合并后不再需要，尽早释放
+        if ok and source.digest is not None:
+            self.digests[source.digest] = sourceId
+            self.parsed[source.digest] = ([], None)
+        if source.content is not None and not isinstance(source.content, int): source.content = ''
+
+def resolve_host(host: str) -> Optional[str]:
+    try: return str(ipaddress.ip_address(host.strip('[]')))
+    except ValueError: pass
+    try: infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError): return None
+    ips = []
+    for info in infos:
+        try: ips.append(ipaddress.ip_address(info[4][0]))
+        except ValueError: pass
+    # 有多个地址时优先取 IPv4 中最小的一个，保证只有 IPv4 记录的别名与双栈的别名得到相同的结果
+    return str(min(ips, key=lambda _: (_.version, _))) if ips else None
+
+class Resolver:
+    # 有界线程池并发解析域名，同一次运行内相同域名只解析一次；resolve 可以替换为其它实现
+    def __init__(self, resolve: Callable[[str], Optional[str]] = resolve_host,
+                 workers: int = RESOLVE_WORKERS, deadline: float = RESOLVE_DEADLINE) -> None:
+        self.resolve = resolve
+        self.workers = workers
+        self.deadline = deadline
+        self.cache: Dict[str, Optional[str]] = {}
+
+    def resolve_all(self, hosts: Iterable[str]) -> Dict[str, Optional[str]]:
+        hosts = list(dict.fromkeys(hosts))
+        todo = [_ for _ in hosts if _ not in self.cache]
+        if todo:
+            pool = ThreadPoolExecutor(min(self.workers, len(todo)))
+            futures = {pool.submit(self.resolve, _): _ for _ in todo}
+            wait(futures, timeout=self.deadline)
+            for fut, host in futures.items():
+                self.cache[host] = fut.result() if fut.done() and not fut.exception() else None
+            pool.shutdown(wait=False, cancel_futures=True)
+        return {_: self.cache[_] for _ in hosts}
+
+def is_fake_addr(addr: str) -> bool:
+    if addr in FAKE_IPS: return True
+    ip = ipaddress.ip_address(addr)
+    return not ip.is_global
+
+def dedup_by_address(resolver: Resolver) -> Tuple[int, int]:
+    # 把服务器解析到同一地址（且其余连接参数相同）的节点合并为一个，并丢弃解析到假地址的节点
+    global merged, used
+    addrs = resolver.resolve_all(str(p.data['server']).lower() for p in merged.values() if 'server' in p.data)
+    seen: Dict[Tuple, Tuple] = {}
+    dups = fakes = 0
+    for key, p in list(merged.items()):
+        p.addr = addrs.get(str(p.data.get('server', '')).lower())
+        if p.addr is None or key[0] == '__ERROR__': continue
+        if is_fake_addr(p.addr):
+            del merged[key]
+            used.pop(key, None)
+            fakes += 1
+            continue
+        # 域名仍用作 SNI 或 Host 时保留域名；去重键中没有的 TLS 设置也要相同，只合并真正连接到同一目标的节点
+        akey = (key[0], p.addr, key[1] if p.uses_hostname() else None,
+                bool(p.data.get('tls')), p.data.get('servername')) + key[2:]
+        if akey not in seen:
+            seen[akey] = key
+            continue
+        # 保留先出现的节点，来源记录合并过去
+        first = seen[akey]
+        for sourceId, name in used.pop(key, {}).items():
+            used.setdefault(first, {}).setdefault(sourceId, name)
+        del merged[key]
+        dups += 1
+    return dups, fakes
+
+GITHUB_FILE_RE = re.compile(r'^https?://github\.com/([^/]+)/([^/]+)/(?:blob|raw)/([^?#]+)(?:\?raw=true)?$')
+
+def canonical_url(url: str) -> str:
+    # github.com 上的文件页面与 raw.githubusercontent.com 是同一个文件，统一换成后者，
+    # 否则页面抓到的是 HTML，而且同一个文件会被抓取两次
+    m = GITHUB_FILE_RE.match(url)
+    if m: return "https://raw.githubusercontent.com/%s/%s/%s" % m.groups()
+    return url
 
 def raw2fastly(url: str) -> str:
     # 由于 Fastly CDN 不好用，因此换成 ghproxy.net，见 README。
@@ -634,28 +1757,107 @@ def raw2fastly(url: str) -> str:
         return "https://ghproxy.com/"+url
     return url
 
+def parse_adblock_line(line: bytes) -> Optional[str]:
+    line = line.strip()
+    if line[:2] == b'||' and (b'/' not in line) and (b'?' not in line) and \
+                    (line[-1:] == b'^' or line.endswith(b"$all")):
+        return line.strip(b'al').strip(b'|^$').decode(errors='ignore')
+    return None
+
+class AdblockCache:
+    # 按内容哈希缓存每个列表解析出的域名，列表未变化时无需再次解析
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.used: Set[str] = set()
+
+    def load(self, digest: Optional[str]) -> Optional[Set[str]]:
+        if not digest: return None
+        try:
+            with open(os.path.join(self.path, digest), encoding="utf-8") as f:
+                domains = set(f.read().splitlines())
+        except OSError: return None
+        self.used.add(digest)
+        return domains
+
+    def store(self, digest: str, domains: Set[str]) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, digest+".tmp")
+        with open(tmp, 'w', encoding="utf-8") as f:
+            f.write('\n'.join(domains))
+        os.replace(tmp, os.path.join(self.path, digest))
+        self.used.add(digest)
+
+    def prune(self) -> None:
+        if not os.path.isdir(self.path): return
+        for name in os.listdir(self.path):
+            if name not in self.used:
+                os.remove(os.path.join(self.path, name))
+
+adblock_cache = AdblockCache(os.path.join(CACHE_DIR, "adblock"))
+
+def fetch_adblock(url: str) -> Optional[Set[str]]:
+    url = raw2fastly(url)
+    deadline = time.monotonic() + ADBLOCK_DEADLINE
+    try:
+        with session.get(url, stream=True, timeout=FETCH_TIMEOUT,
+                         headers=http_cache.headers(url)) as r, wall_deadline(r, deadline):
+            if r.status_code == 304:
+                digest = http_cache.digest(url)
+                domains = adblock_cache.load(digest)
+                if domains is not None: return domains
+                body = http_cache.load(url)
+                if body is None:
+                    print(url, "缓存丢失")
+                    return None
+                domains = set()
+                for line in body.splitlines():
+                    domain = parse_adblock_line(line)
+                    if domain: domains.add(domain)
+                adblock_cache.store(digest, domains)
+                return domains
+            if r.status_code != 200:
+                print(url, r.status_code)
+                return None
+            # 边下载边解析，同时计算内容哈希
+            body = bytearray()
+            hasher = hashlib.sha256()
+            domains = set()
+            pending = b''
+            for chunk in r.iter_content(FETCH_CHUNK_SIZE):
+                if time.monotonic() > deadline: raise TimeoutError
+                body += chunk
+                hasher.update(chunk)
+                lines = (pending+chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    domain = parse_adblock_line(line)
+                    if domain: domains.add(domain)
+            domain = parse_adblock_line(pending)
+            if domain: domains.add(domain)
+            digest = hasher.hexdigest()
+            http_cache.store(url, r.headers, body, digest)
+            adblock_cache.store(digest, domains)
+            return domains
+    except (TimeoutError, requests.exceptions.Timeout):
+        print(f"{url} 下载超时！")
+    except requests.exceptions.RequestException as e:
+        if is_timeout(e):
+            print(f"{url} 下载超时！")
+            return None
+        try:
+            print(f"{url} 下载失败：{e.args[0].reason}")
+        except Exception:
+            print(f"{url} 下载失败：无法解析的错误！")
+            traceback.print_exc()
+    return None
+
 def merge_adblock(adblock_name: str, rules: Dict[str, str]) -> None:
     print("正在解析 Adblock 列表... ", end='', flush=True)
     blocked: Set[str] = set()
-    for url in ABFURLS:
-        url = raw2fastly(url)
-        try:
-            res = session.get(url)
-        except requests.exceptions.RequestException as e:
-            try:
-                print(f"{url} 下载失败：{e.args[0].reason}")
-            except Exception:
-                print(f"{url} 下载失败：无法解析的错误！")
-                traceback.print_exc()
-            continue
-        if res.status_code != 200:
-            print(url, res.status_code)
-            continue
-        for line in res.text.strip().splitlines():
-            line = line.strip()
-            if line[:2] == '||' and ('/' not in line) and ('?' not in line) and \
-                            (line[-1] == '^' or line.endswith("$all")):
-                blocked.add(line.strip('al').strip('|^$'))
+    with ThreadPoolExecutor(ADBLOCK_WORKERS) as pool:
+        for domains in pool.map(fetch_adblock, ABFURLS):
+            if domains: blocked |= domains
+    adblock_cache.prune()
 
     domain_root = DomainTree()
     domain_keys = set()
@@ -679,24 +1881,56 @@ def merge_adblock(adblock_name: str, rules: Dict[str, str]) -> None:
     for domain in domain_keys:
         rules[f'DOMAIN-KEYWORD,{domain}'] = adblock_name
 
-    for domain in domain_root.get():
-        for key in domain_keys:
-            if key in domain: break
-        else: rules[f'DOMAIN-SUFFIX,{domain}'] = adblock_name
+    matcher = KeywordMatcher(domain_keys)
+    for domain in domain_root.iter_suffixes():
+        if not matcher.search(domain):
+            rules[f'DOMAIN-SUFFIX,{domain}'] = adblock_name
 
     print(f"共有 {len(rules)} 条规则")
 
+def write_report(path: str, watch: Stopwatch, sources_obj: List[Source]) -> None:
+    # 机器可读的运行报告，与 list_result.csv 放在一起
+    report_sources = []
+    for i, source in enumerate(sources_obj):
+        stats = dict(id=i, url=source.url, status=source.stats.get('status'),
+                     bytes=source.stats.get('bytes', 0), latency=source.stats.get('latency'),
+                     parse_time=source.stats.get('parse_time'), nodes=source.stats.get('nodes', 0),
+                     unique=source.stats.get('unique', 0), duplicate_of=source.duplicate_of)
+        if source.skipped: pass
+        elif source.abandoned or source.content is None: stats['status'] = 'timeout' # 超过期限被放弃
+        elif isinstance(source.content, int) and source.content < 0:
+            stats['status'] = {-1: 'error', -2: 'exception', -3: 'timeout'}[source.content]
+        # 去重命中率：该订阅的节点中已经在之前的订阅中出现过的比例
+        stats['dedup_rate'] = round(1 - stats['unique'] / stats['nodes'], 4) if stats['nodes'] else None
+        report_sources.append(stats)
+    report = {
+        'started': watch.started.isoformat(timespec='seconds'),
+        'total': watch.total,
+        'stages': watch.stages,
+        'nodes': {'merged': len(merged), 'unknown': len(unknown)},
+        'sources': report_sources,
+    }
+    with atomic_open(path) as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+
 def main():
-    global exc_queue, FETCH_TIMEOUT, ABFURLS, AUTOURLS, AUTOFETCH
+    global exc_queue, ABFURLS, AUTOURLS, AUTOFETCH
     sources = open("sources.list", encoding="utf-8").read().strip().splitlines()
     if DEBUG_NO_NODES:
         # !!! JUST FOR DEBUGING !!!
         print("!!! 警告：您已启用无节点调试，程序产生的配置不能被直接使用 !!!")
         AUTOURLS = AUTOFETCH = sources = []
+    watch = Stopwatch()
+    from dynamic import DynamicRunner
+    # 所有动态生成函数（包括内容抓取的）一起开始运行，内容抓取的结果在抓取阶段再取用
+    runner = DynamicRunner()
+    url_futures = [(auto_fun, runner.submit(auto_fun)) for auto_fun in AUTOURLS]
+    AUTOFETCH = [runner.wrap(auto_fun) for auto_fun in AUTOFETCH]
     print("正在生成动态链接...")
-    for auto_fun in AUTOURLS:
+    for auto_fun, fut in url_futures:
         print("正在生成 '"+auto_fun.__name__+"'... ", end='', flush=True)
-        try: url = auto_fun()
+        try: url = runner.result(fut)
+        except TimeoutError: print("超时！")
         except requests.exceptions.RequestException: print("失败！")
         except: print("错误：");traceback.print_exc()
         else:
@@ -707,8 +1941,10 @@ def main():
                     sources.extend(url)
                 print("成功！")
             else: print("跳过！")
+    watch.lap('dynamic')
     print("正在整理链接...")
     sources_final = set()
+    aliases = 0 # 规范化后与其它链接相同，不必再抓取的链接数
     airports = set()
     for source in sources:
         if not source: continue
@@ -724,100 +1960,131 @@ def main():
         if sub[0] == '+':
             tags = sub.split()
             sub = tags.pop()
-            sub = ' '.join(tags) + ' ' +raw2fastly(sub)
+            sub = ' '.join(tags) + ' ' +raw2fastly(canonical_url(sub))
         else:
-            sub = raw2fastly(sub)
+            sub = raw2fastly(canonical_url(sub))
         if isairport: airports.add(sub)
+        elif sub in sources_final: aliases += 1
         else: sources_final.add(sub)
 
-    if airports:
-        print("正在抓取机场列表...")
-        for sub in airports:
-            print("合并 '"+sub+"'... ", end='', flush=True)
-            try:
-                res = extract(sub)
-            except KeyboardInterrupt:
-                print("正在退出...")
-                break
-            except requests.exceptions.RequestException:
-                print("合并失败！")
-            except: traceback.print_exc()
-            else:
-                if isinstance(res, int):
-                    print(res)
-                else:
-                    for url in res:
-                        sources_final.add(url)
-                    print("完成！")
-
     print("正在整理链接...")
     sources_final = list(sources_final)
     sources_final.sort()
     sources_obj = [Source(url) for url in (sources_final + AUTOFETCH)]
+    ids: Dict[Source, int] = {source: i for i, source in enumerate(sources_obj)}
 
     print("开始抓取！")
-    threads = [threading.Thread(target=_.get, daemon=True) for _ in sources_obj]
-    for thread in threads: thread.start()
-    for i in range(len(sources_obj)):
-        try:
-            for t in range(1, FETCH_TIMEOUT[0]+1):
-                print("抓取 '"+sources_obj[i].url+"'... ", end='', flush=True)
-                try: threads[i].join(timeout=FETCH_TIMEOUT[1])
-                except KeyboardInterrupt:
-                    print("正在退出...")
-                    FETCH_TIMEOUT = (1, 0)
-                    break
-                if not threads[i].is_alive(): break
-                print(f"{5*t}s")
-            if threads[i].is_alive():
-                print("超时！")
-                continue
-            res = sources_obj[i].content
-            if isinstance(res, int):
-                if res < 0: print("抓取失败！")
-                else: print(res)
-            else:
-                print("正在合并... ", end='', flush=True)
-                try:
-                    merge(sources_obj[i], sourceId=i)
-                except KeyboardInterrupt:
-                    print("正在退出...")
-                    break
-                except:
-                    print("失败！")
-                    traceback.print_exc()
-                else: print("完成！")
-        except KeyboardInterrupt:
-            print("正在退出...")
-            break
+    fetcher = Fetcher()
+    # 解析进程使用 spawn 启动，避免在抓取线程运行时 fork
+    parser = ProcessPoolExecutor(PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    # 抓取、解析、合并三个阶段同时进行，之间用有界队列连接，任何一个阶段跟不上时前面的阶段会停下来等待
+    slots = threading.Semaphore(PARSE_INFLIGHT)
+    merger = Merger(fetcher)
+    fetcher.urgent = lambda source: ids.get(source) == merger.next
+    # 按历史表现排序：独有节点多的订阅先抓取；连续失败的订阅暂时跳过，只占住序号
+    skipped = 0
+    for i in sorted(range(len(sources_obj)), key=lambda _: source_history.priority(sources_obj[_].history_key)):
+        if sources_obj[i].schedule(): fetcher.submit(i, sources_obj[i])
+        else: skipped += 1
+    if skipped: print(f"根据历史记录跳过 {skipped} 个订阅。")
+    # 机场列表与订阅同时抓取，其中的订阅排在订阅列表之后；分配序号之前抓取完成的先放在 parked 中
+    if airports: print("正在展开机场列表...")
+    expander = AirportExpander(sorted(airports), fetcher, ids, set(sources_final))
+    parked: Dict[Source, Optional[List[Future]]] = {}
+    # 内容相同（哈希相同）的订阅只解析一次，共用解析结果；合并时只合并序号最小的一个
+    parsed = merger.parsed
+    for i, source in enumerate(sources_obj):
+        if source.skipped: merger.put(i, source, None)
+    try:
+        for item in fetcher.results():
+            if item is not None:
+                _, source, finished = item
+                res = source.content
+                if not finished or isinstance(res, int):
+                    if not finished or res == -3: status = "超时！"
+                    elif res < 0: status = "抓取失败！"
+                    else: status = str(res)
+                    futures = None
+                elif source.size and source.digest in parsed:
+                    status = "完成！（内容重复）"
+                    futures, records = parsed[source.digest]
+                    if source.records is None: source.records = records
+                else:
+                    status = "完成！"
+                    futures = submit_parse(parser, source.sub, slots) if source.sub else []
+                    if source.size: parsed[source.digest] = (futures, source.records)
+                print("抓取 '"+source.url+"'... "+status+'\n', end='', flush=True)
+                if source in ids: merger.put(ids[source], source, futures)
+                else: parked[source] = futures
+            for i, source in expander.finalize(sources_obj):
+                if source in parked: merger.put(i, source, parked.pop(source))
+                elif source.skipped: merger.put(i, source, None)
+                else: fetcher.retire()
+            while exc_queue:
+                print(exc_queue.pop(0), file=sys.stderr, flush=True)
+        for i, source in expander.finalize(sources_obj, block=True):
+            merger.put(i, source, None if source.skipped else parked.pop(source))
         while exc_queue:
             print(exc_queue.pop(0), file=sys.stderr, flush=True)
+        merger.close()
+    except KeyboardInterrupt:
+        print("正在退出...")
+        parser.shutdown(cancel_futures=True)
+        merger.close()
+    parser.shutdown(cancel_futures=True)
+    runner.close()
+    watch.lap('fetch')
+    if airports: watch.record('airports', expander.elapsed)
+    # 解析与合并和抓取同时进行，耗时包含在 fetch 中，这里单独记下
+    watch.record('parse', merger.parse_time)
+    watch.record('merge', merger.merge_time)
+
+    if RESOLVE_NODES:
+        print("正在解析节点域名...", end='', flush=True)
+        dups, fakes = dedup_by_address(Resolver())
+        print(f"合并了 {dups} 个地址重复的节点，丢弃了 {fakes} 个假节点。")
+        watch.lap('resolve')
+
+    if PROBE_NODES:
+        print("正在测试节点连通性...", end='', flush=True)
+        endpoints = {key: p.endpoint(PROBE_TLS) for key, p in merged.items()}
+        results = probe_cached((_ for _ in endpoints.values() if _), probe_cache)
+        for key, p in merged.items():
+            if endpoints[key]: p.rtt = results[endpoints[key]][1]
+        order = sorted(merged.items(), key=lambda _: (_[1].rtt is None, _[1].rtt or 0))
+        alive = sum(1 for _ in order if _[1].rtt is not None)
+        if PROBE_DROP_DEAD: order = order[:alive]
+        merged.clear()
+        merged.update(order)
+        print(f"共测试 {len(results)} 个地址，{alive} 个节点可以连通。")
+        watch.lap('probe')
 
     print("\n正在写出 V2Ray 订阅...")
-    txt = ""
     unsupports = 0
-    for hashp, p in merged.items():
-        try:
-            if hashp in used:
-                # 注意：这一步也会影响到下方的 Clash 订阅，不用再执行一遍！
-                p.data['name'] = ','.join([str(_) for _ in sorted(list(used[hash(p)]))])+'|'+p.data['name']
-            if p.supports_ray():
-                txt += p.url + '\n'
-            else: unsupports += 1
-        except: traceback.print_exc()
-    for p in unknown:
-        txt += p+'\n'
+    with atomic_open("list_raw.txt") as f_raw, atomic_open("list.txt") as f_b64:
+        b64 = Base64Writer(f_b64)
+        for key, p in merged.items():
+            try:
+                if key in used:
+                    # 注意：这一步也会影响到下方的 Clash 订阅，不用再执行一遍！
+                    p.update({'name': ','.join([str(_) for _ in sorted(list(used[key]))])+'|'+p.data['name']})
+                if p.supports_ray():
+                    line = p.url + '\n'
+                    f_raw.write(line)
+                    b64.write(line)
+                else: unsupports += 1
+            except: traceback.print_exc()
+        for p in unknown:
+            f_raw.write(p+'\n')
+            b64.write(p+'\n')
+        b64.close()
     print(f"共有 {len(merged)-unsupports} 个正常节点，{len(unknown)} 个无法解析的节点，共",
             len(merged)+len(unknown),f"个。{unsupports} 个节点不被 V2Ray 支持。")
-
-    with open("list_raw.txt",'w') as f:
-        f.write(txt)
-    with open("list.txt",'w') as f:
-        f.write(b64encodes(txt))
     print("写出完成！")
+    watch.lap('write_v2ray')
 
     with open("config.yml", encoding="utf-8") as f:
-        conf: Dict[str, Any] = yaml.full_load(f)
+        conf: Dict[str, Any] = yaml_load(f)
     
     rules: Dict[str, str] = {}
     if DEBUG_NO_ADBLOCK:
@@ -825,13 +2092,14 @@ def main():
         print("!!! 警告：您已关闭对 Adblock 规则的抓取 !!!")
     else:
         merge_adblock(conf['proxy-groups'][-2]['name'], rules)
+    watch.lap('adblock')
 
     snip_conf: Dict[str, Dict[str, Any]] = {}
     ctg_nodes: Dict[str, List[Node.DATA_TYPE]] = {}
     categories: Dict[str, List[str]] = {}
     try:
         with open("snippets/_config.yml", encoding="utf-8") as f:
-            snip_conf = yaml.full_load(f)
+            snip_conf = yaml_load(f)
     except (OSError, yaml.error.YAMLError):
         print("片段配置读取失败：")
         traceback.print_exc()
@@ -839,21 +2107,17 @@ def main():
         print("正在按地区分类节点...")
         categories = snip_conf['categories']
         for ctg in categories: ctg_nodes[ctg] = []
+        classifier = RegionClassifier(categories)
         for node in merged.values():
             if node.supports_clash():
-                ctgs = []
-                for ctg, keys in categories.items():
-                    for key in keys:
-                        if key in node.name:
-                            ctgs.append(ctg)
-                            break
-                    if ctgs and keys[-1] == 'OVERALL':
-                        break
+                ctgs = classifier.classify(node.name)
                 if len(ctgs) == 1:
+                    node.region = ctgs[0]
                     ctg_nodes[ctgs[0]].append(node.clash_data)
         for ctg, proxies in ctg_nodes.items():
-            with open("snippets/nodes_"+ctg+".yml", 'w', encoding="utf-8") as f:
-                yaml.dump({'proxies': proxies}, f, allow_unicode=True)
+            with atomic_open("snippets/nodes_"+ctg+".yml") as f:
+                dump_clash({'proxies': proxies}, f)
+    watch.lap('classify')
 
     # print("正在抓取 Google IP 列表... ", end='', flush=True)
     # proxy_name: str = conf['proxy-groups'][0]['name']
@@ -912,10 +2176,11 @@ def main():
                 else: disp['proxies'] = [_['name'] for _ in payload]
                 conf['proxy-groups'].append(disp)
                 ctg_selects.append(disp['name'])
-    with open("list.yml", 'w', encoding="utf-8") as f:
-        f.write(yaml.dump(conf, allow_unicode=True).replace('!!str ',''))
-    with open("snippets/nodes.yml", 'w', encoding="utf-8") as f:
-        f.write(yaml.dump({'proxies': conf['proxies']}, allow_unicode=True).replace('!!str ',''))
+    with atomic_open("list.yml") as f:
+        dump_clash(conf, f)
+    with atomic_open("snippets/nodes.yml") as f:
+        dump_clash({'proxies': conf['proxies']}, f)
+    watch.lap('write_clash')
 
     if snip_conf:
         print("正在写出配置片段...")
@@ -927,21 +2192,53 @@ def main():
             if rpolicy in name_map:
                 snippets[name_map[rpolicy]].append(rule)
         for name, payload in snippets.items():
-            with open("snippets/"+name+".yml", 'w', encoding="utf-8") as f:
-                yaml.dump({'payload': payload}, f, allow_unicode=True)
+            with atomic_open("snippets/"+name+".yml") as f:
+                dump_clash({'payload': payload}, f)
+        watch.lap('write_snippets')
 
     print("正在写出统计信息...")
-    out = "序号,链接,节点数\n"
+    with atomic_open("list_result.csv") as f:
+        f.write("序号,链接,节点数,内容相同的订阅\n")
+        duplicates = 0
+        for i, source in enumerate(sources_obj):
+            if source.duplicate_of is None: f.write(f"{i},{source.url},{source.size},\n")
+            else:
+                duplicates += 1
+                f.write(f"{i},{source.url},{source.size},{source.duplicate_of}\n")
+        f.write(f"\n总计,,{len(merged)},\n")
+        f.write(f"重复链接,,{aliases},\n")
+        f.write(f"内容重复,,{duplicates},\n")
+    watch.lap('write_csv')
+
+    print("正在更新节点库...")
+    node_store.put_nodes((key, p.type, p.url if p.supports_ray() else None,
+                          sorted({sources_obj[_].url for _ in used.get(key, ())}))
+                         for key, p in merged.items())
+    node_store.save()
+    http_cache.save()
+    if PROBE_NODES: probe_cache.save()
+    # 独有节点：去重后只来自这一个订阅的节点
+    exclusive: Dict[int, int] = {}
+    for sids in used.values():
+        if len(sids) == 1:
+            sid = next(iter(sids))
+            exclusive[sid] = exclusive.get(sid, 0) + 1
+    def outcome(source: Source) -> Optional[bool]:
+        # 超时记为 None；内容重复的订阅沿用与之相同的那个订阅的结果
+        if source.abandoned or source.content is None or source.content == -3: return None
+        if source.duplicate_of is not None: return outcome(sources_obj[source.duplicate_of])
+        return not isinstance(source.content, int) and source.size > 0
     for i, source in enumerate(sources_obj):
-        out += f"{i},{source.url},"
-        try: out += f"{len(source.sub)}"
-        except: out += '0'
-        out += '\n'
-    out += f"\n总计,,{len(merged)}\n"
-    open("list_result.csv",'w').write(out)
+        if source.skipped: continue
+        source_history.record(source.history_key, outcome(source), source.stats.get('latency'), exclusive.get(i, 0))
+    source_history.save()
+    watch.lap('save_caches')
 
+    write_report("list_report.json", watch, sources_obj)
     print("写出完成！")
 
 if __name__ == '__main__':
+    # 作为脚本运行时本模块名为 __main__；先登记为 fetch，dynamic.py 导入的才是同一个模块（同一个 session）
+    sys.modules.setdefault('fetch', sys.modules[__name__])
     from dynamic import AUTOURLS, AUTOFETCH
     main()
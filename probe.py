@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import asyncio
+import ssl
+import time
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (地址, 端口, TLS 握手使用的 SNI)，SNI 为 None 时只测试 TCP 连接
+Endpoint = Tuple[str, int, Optional[str]]
+# (是否成功, 往返时间（毫秒）)，失败时往返时间为 None
+Result = Tuple[bool, Optional[float]]
+
+PROBE_CONCURRENCY = 512
+PROBE_TIMEOUT = 3 # 单次测试的最长时间（秒），包括域名解析、TCP 连接及 TLS 握手
+PROBE_TTL = 6 * 3600 # 可以连通的结果在这么久内直接使用（秒）
+PROBE_BACKOFF = 3 * 3600 # 无法连通的结果第一次的有效期，之后每连续失败一次翻倍（秒）
+PROBE_BACKOFF_MAX = 7 * 24 * 3600
+PROBE_MAX_STALE = 14 * 24 * 3600 # 过期超过这么久的结果不再使用，重新测试（秒）
+PROBE_REVALIDATE_WAIT = 60 # 退出前最多等待后台重新测试这么久（秒）
+
+def _tls_context() -> ssl.SSLContext:
+    # 免费节点大多使用自签名证书，只测试握手能否完成，不校验证书
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+async def probe_one(endpoint: Endpoint, sem: asyncio.Semaphore, timeout: float,
+                    ctx: Optional[ssl.SSLContext] = None) -> Result:
+    host, port, sni = endpoint
+    async with sem:
+        start = time.monotonic()
+        try:
+            if sni is None:
+                conn = asyncio.open_connection(host, port)
+            else:
+                conn = asyncio.open_connection(host, port, ssl=ctx or _tls_context(), server_hostname=sni)
+            _, writer = await asyncio.wait_for(conn, timeout)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError, ValueError, UnicodeError):
+            return False, None
+        rtt = (time.monotonic() - start) * 1000
+        writer.close()
+        try: await asyncio.wait_for(writer.wait_closed(), 1)
+        except Exception: pass
+        return True, round(rtt, 1)
+
+async def probe_all(endpoints: Iterable[Endpoint], concurrency: int = PROBE_CONCURRENCY,
+                    timeout: float = PROBE_TIMEOUT) -> Dict[Endpoint, Result]:
+    sem = asyncio.Semaphore(concurrency)
+    ctx = _tls_context()
+    todo: List[Endpoint] = list(dict.fromkeys(endpoints)) # 同一地址只测试一次
+    results = await asyncio.gather(*(probe_one(_, sem, timeout, ctx) for _ in todo))
+    return dict(zip(todo, results))
+
+def probe(endpoints: Iterable[Endpoint], concurrency: int = PROBE_CONCURRENCY,
+          timeout: float = PROBE_TIMEOUT) -> Dict[Endpoint, Result]:
+    return asyncio.run(probe_all(endpoints, concurrency, timeout))
+
+def _key(endpoint: Endpoint) -> str:
+    host, port, sni = endpoint
+    return f"{host}|{port}|{sni or ''}"
+
+class ProbeCache:
+    # 按地址保存的测试结果：可以连通的结果有效 ttl 秒；无法连通的结果按连续失败次数指数退避，
+    # 过期但不太旧的结果先照常使用，同时在后台重新测试，供下次运行使用
+    def __init__(self, path: str, ttl: float = PROBE_TTL, backoff: float = PROBE_BACKOFF,
+                 backoff_max: float = PROBE_BACKOFF_MAX, max_stale: float = PROBE_MAX_STALE) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.entries: Dict[str, Dict] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError): pass
+
+    def _expires(self, entry: Dict) -> float:
+        if entry['ok']: return entry['checked'] + self.ttl
+        return entry['checked'] + min(self.backoff * 2 ** (entry['fails']-1), self.backoff_max)
+
+    def lookup(self, endpoint: Endpoint, now: float) -> Tuple[Optional[Result], bool]:
+        # 返回 (缓存的结果, 是否需要重新测试)；没有可用结果时为 (None, True)
+        with self.lock:
+            entry = self.entries.get(_key(endpoint))
+        if entry is None: return None, True
+        expires = self._expires(entry)
+        if now > expires + self.max_stale: return None, True
+        return (entry['ok'], entry['rtt']), now > expires
+
+    def put(self, endpoint: Endpoint, result: Result, now: float) -> None:
+        key = _key(endpoint)
+        with self.lock:
+            old = self.entries.get(key)
+            fails = 0 if result[0] else (old['fails'] if old and not old['ok'] else 0) + 1
+            self.entries[key] = {'ok': result[0], 'rtt': result[1], 'checked': now, 'fails': fails}
+
+    def revalidate(self, endpoints: List[Endpoint], concurrency: int, timeout: float) -> None:
+        def run():
+            for ep, res in probe(endpoints, concurrency, timeout).items():
+                self.put(ep, res, time.time())
+        if endpoints:
+            self.thread = threading.Thread(target=run, daemon=True)
+            self.thread.start()
+
+    def save(self, wait: float = PROBE_REVALIDATE_WAIT) -> None:
+        if self.thread is not None: self.thread.join(wait)
+        with self.lock:
+            now = time.time()
+            entries = {k: v for k, v in self.entries.items()
+                       if now <= self._expires(v) + self.max_stale}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path+".tmp", 'w', encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(self.path+".tmp", self.path)
+
+def probe_cached(endpoints: Iterable[Endpoint], cache: ProbeCache,
+                 concurrency: int = PROBE_CONCURRENCY, timeout: float = PROBE_TIMEOUT) -> Dict[Endpoint, Result]:
+    # 只有从未测试过（或结果太旧）的地址在前台测试，其余直接使用缓存，过期的在后台重新测试
+    now = time.time()
+    results: Dict[Endpoint, Result] = {}
+    missing: List[Endpoint] = []
+    stale: List[Endpoint] = []
+    for ep in dict.fromkeys(endpoints):
+        res, expired = cache.lookup(ep, now)
+        if res is None: missing.append(ep)
+        else:
+            results[ep] = res
+            if expired: stale.append(ep)
+    for ep, res in probe(missing, concurrency, timeout).items():
+        cache.put(ep, res, now)
+        results[ep] = res
+    cache.revalidate(stale, concurrency, timeout)
+    return results
+
+if __name__ == '__main__':
+    # 用法：python probe.py 地址:端口[:SNI] ...
+    import sys
+    eps: List[Endpoint] = []
+    for arg in sys.argv[1:]:
+        parts = arg.split(':')
+        eps.append((parts[0], int(parts[1]), parts[2] if len(parts) > 2 else None))
+    for ep, (ok, rtt) in probe(eps).items():
+        print(ep, f"{rtt} ms" if ok else "失败")